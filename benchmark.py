@@ -0,0 +1,218 @@
+"""Matching benchmark with synthetic user populations.
+
+Seeds a MongoDB (mongomock by default, or a local server with --mongo-url)
+with synthetic User documents, then drives find_match / try_find_match and
+the message relay path of bot.py at the given concurrency and reports
+latency percentiles and throughput.
+
+The default in-memory database needs mongomock, which the bot itself does
+not use:
+
+    pip install -r requirements-dev.txt
+
+    python benchmark.py --users 1000,10000,100000 --concurrency 50
+    python benchmark.py --mongo-url mongodb://localhost:27017 --users 10000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+from matching import FULLY_RELAXED
+
+SPORTS = ["Tennis", "Badminton", "Basketball", "Football", "Squash", "Table Tennis"]
+GENDERS = ["Male", "Female"]
+SKILL_LEVELS = ["Beginner", "Intermediate", "Advanced"]
+LOCATIONS = ["North", "South", "East", "West", "Central"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1000,10000", help="comma separated waiting pool sizes to benchmark")
+    parser.add_argument("--searches", type=int, default=500, help="match searches per pool size")
+    parser.add_argument("--messages", type=int, default=2000, help="relayed chat messages per pool size")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent searches/messages")
+    parser.add_argument("--string-preferences", type=float, default=0.5,
+                        help="fraction of users whose matchPreferences are stored as a JSON string")
+    parser.add_argument("--smart-match", type=float, default=0.7, help="fraction of users with Smart-Match on")
+    parser.add_argument("--ranking", action="store_true", help="rank candidates by score instead of waiting time")
+    parser.add_argument("--mongo-url",
+                        help="benchmark against this MongoDB instead of mongomock (pip install -r requirements-dev.txt)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def synthetic_user(telegram_id, args, rng, now):
+    sports = {sport: rng.choice(SKILL_LEVELS) for sport in rng.sample(SPORTS, rng.randint(1, 3))}
+    match_preferences = {}
+    for sport in sports:
+        low = rng.randint(18, 40)
+        match_preferences[sport] = {
+            "ageRange": [low, low + rng.randint(5, 30)],
+            "genderPreference": rng.choice(GENDERS + ["No preference"]),
+            "skillLevels": rng.sample(SKILL_LEVELS, rng.randint(0, 3)),
+            "locationPreferences": rng.sample(LOCATIONS, rng.randint(1, 3)),
+        }
+    if rng.random() < args.string_preferences:
+        match_preferences = json.dumps(match_preferences)
+    # Some users search for several of their sports at once, each with its own Smart-Match setting
+    sport_searches = []
+    for sport in rng.sample(list(sports), rng.randint(1, len(sports))):
+        smart_match = rng.random() < args.smart_match
+        sport_searches.append({
+            "sport": sport,
+            "smartMatch": smart_match,
+            # Smart-Match searches are spread over the relaxation stages
+            "smartMatchStage": rng.randint(0, FULLY_RELAXED) if smart_match else 0,
+            "matchStartTime": now - datetime.timedelta(seconds=rng.randint(0, 3600)),
+        })
+    return {
+        "telegramId": telegram_id,
+        "username": f"user{telegram_id}",
+        "displayName": f"User {telegram_id}",
+        # Ages are stored as strings by some versions of the web app
+        "age": str(rng.randint(18, 65)) if rng.random() < 0.5 else rng.randint(18, 65),
+        "gender": rng.choice(GENDERS),
+        "sports": sports,
+        "matchPreferences": match_preferences,
+        "wantToBeMatched": True,
+        "selectedSport": sport_searches[-1]["sport"],
+        "sportSearches": sport_searches,
+        "isMatched": False,
+    }
+
+
+class NullBot:
+    """Stands in for the Telegram Bot: every outbound message is dropped."""
+
+    async def send_message(self, **kwargs):
+        return None
+
+
+def fake_message_update(telegram_id, text):
+    user = SimpleNamespace(id=telegram_id, first_name="Bench", username=f"user{telegram_id}")
+    return SimpleNamespace(message=SimpleNamespace(from_user=user, text=text))
+
+
+async def timed_run(calls, concurrency):
+    """Run the coroutine factories in `calls` with bounded concurrency; return latencies and wall time."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(call):
+        async with semaphore:
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(call) for call in calls))
+    return latencies, time.perf_counter() - started
+
+
+def report(name, pool_size, latencies, wall_time):
+    if not latencies:
+        print(f"{name:<16} {pool_size:>8}  (no operations)")
+        return
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(f"{name:<16} {pool_size:>8} {len(latencies):>7} {p50:>10.2f} {p99:>10.2f} {len(latencies) / wall_time:>12.1f}")
+
+
+async def benchmark_pool(bot, db, pool_size, args):
+    rng = random.Random(args.seed + pool_size)
+    now = datetime.datetime.now()
+
+    # Fresh collections and in-process state for every pool size
+    for name in ["User", "Match", "Feedback"]:
+        db[name].drop()
+    bot.user_cache.clear()
+    bot.preference_cache.entries.clear()
+    bot.active_partners.clear()
+    users = [synthetic_user(telegram_id, args, rng, now) for telegram_id in range(1, pool_size + 1)]
+    db["User"].insert_many(users)
+    await bot.ensure_indexes()
+    started = time.perf_counter()
+    await bot.load_matching_pool()
+    print(f"{'load pool':<16} {pool_size:>8} {pool_size:>7} {'':>10} {'':>10} {pool_size / (time.perf_counter() - started):>12.1f}")
+
+    context = SimpleNamespace(bot=NullBot())
+    searchers = rng.sample(users, min(args.searches, pool_size))
+
+    # Strict searches straight through try_find_match
+    half = len(searchers) // 2
+    latencies, wall_time = await timed_run(
+        [lambda user=user: bot.try_find_match(user["telegramId"], user["selectedSport"], context)
+         for user in searchers[:half]],
+        args.concurrency,
+    )
+    report("try_find_match", pool_size, latencies, wall_time)
+
+    # Full /matchme flow after the sport and Smart-Match choice
+    latencies, wall_time = await timed_run(
+        [lambda user=user: bot.find_match(user["telegramId"], user["selectedSport"], context, bot.sport_search(user, user["selectedSport"])["smartMatch"])
+         for user in searchers[half:]],
+        args.concurrency,
+    )
+    report("find_match", pool_size, latencies, wall_time)
+
+    # One batch pass over every sport's pool, then the next one, which only
+    # searches again for the entries that changed in between
+    latencies, wall_time = await timed_run([lambda: bot.matching_sweep(context)], 1)
+    report("matching_sweep", pool_size, latencies, wall_time)
+    latencies, wall_time = await timed_run([lambda: bot.matching_sweep(context)], 1)
+    report("repeat sweep", pool_size, latencies, wall_time)
+
+    # Chat relay between matched players
+    matched_ids = list(bot.active_partners)
+    if matched_ids:
+        latencies, wall_time = await timed_run(
+            [lambda telegram_id=rng.choice(matched_ids): bot.forward_message(fake_message_update(telegram_id, "See you at 6?"), context)
+             for _ in range(args.messages)],
+            args.concurrency,
+        )
+        report("forward_message", pool_size, latencies, wall_time)
+
+
+async def main(args):
+    import bot
+    from config import Config
+
+    # No Telegram application is needed, only the services the handlers use
+    bot.configure(Config(
+        database_url=args.mongo_url,
+        database_name="sportsfinder_benchmark",
+        # mongomock is not thread-safe, keep its calls on a single worker thread
+        db_thread_pool_size=None if args.mongo_url else 1,
+        # Messages go nowhere, so don't rate limit them
+        outbound_global_rate=1e9,
+        outbound_per_chat_rate=1e9,
+        match_ranking=args.ranking,
+    ))
+    if args.mongo_url:
+        db = bot.get_database()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("The benchmark needs mongomock without --mongo-url: pip install -r requirements-dev.txt")
+        db = mongomock.MongoClient()["sportsfinder_benchmark"]
+        bot.users_collection.collection = db["User"]
+        bot.matches_collection.collection = db["Match"]
+        bot.feedback_collection.collection = db["Feedback"]
+    bot.outbound.start(NullBot())
+
+    print(f"{'operation':<16} {'pool':>8} {'ops':>7} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>12}")
+    for pool_size in [int(size) for size in args.users.split(",")]:
+        await benchmark_pool(bot, db, pool_size, args)
+    await bot.outbound.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
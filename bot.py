@@ -1,7 +1,10 @@
-from pymongo import MongoClient
-import os
-from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import time
+IMPORT_STARTED = time.perf_counter()  # Start of the cold-start budget checked in check_startup_budget()
+
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from bson import ObjectId
+from telegram import Bot, Update
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
@@ -11,40 +14,520 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,  # Import ContextTypes
 )
-from bson import ObjectId
+import callbacks
+import templates
+from templates import NO_GAME_REASONS
+from config import Config
+from outbound import OutboundDispatcher
+from write_buffer import WriteBehindBuffer
+from persistence import MongoPersistence
+from metrics import MetricsRegistry, Gauge, CollectedCounter, current_handler
+from webhook import routing_key, serve_http
+from user_cache import UserCache
+from matching import MatchingEngine, WaitingUser, PreferenceCache, NO_PREFERENCES, FULLY_RELAXED
 import json
+import sys
 import datetime
-from telegram.ext import JobQueue
 import asyncio
+import functools
+import logging
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
-# Load environment variables from .env file
-load_dotenv()
-
-TOKEN = os.getenv("BOT_TOKEN")
-DATABASE_URL = os.getenv("DATABASE_URL")  # MongoDB connection string
+logger = logging.getLogger("sportsfinder")
 
-# Connect to MongoDB
-mongo_client = MongoClient(DATABASE_URL)
-db = mongo_client["test_database"]  # Use the database "sportsfinder"
-users_collection = db["User"]  # Use the collection "users"
-matches_collection = db["Match"]  # Use the collection "matches"
-feedback_collection = db["Feedback"]  # Use the collection "Feedback"
+# Settings, set by configure() / create_app()
+config = Config()
 
-# Create the Telegram Bot application
-application = Application.builder().token(TOKEN).build()
-
-# Mapping reason numbers to their full text descriptions
-NO_GAME_REASONS = {
-    "1": "Couldn’t find a common date",
-    "2": "Match was unresponsive/unwilling to play",
-    "3": "Uncomfortable with other player",
-    "4": "Decided not to play",
-    "5": "Others"
+# Logging, e.g. LOG_LEVEL=DEBUG to see the matching and feedback debug output
+def configure_logging(config):
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        level=config.log_level
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # Logs every Telegram API request at INFO
+
+# Prometheus metrics are served on http://<metrics_host>:<metrics_port>/metrics when enabled by configure()
+metrics_registry = MetricsRegistry(enabled=False)
+
+# MongoDB client, created on first use so importing bot.py doesn't connect anywhere
+mongo_client = None
+
+def get_database():
+    global mongo_client
+    if mongo_client is None:
+        mongo_client = MongoClient(
+            config.database_url,
+            maxPoolSize=config.mongo_max_pool_size,
+            serverSelectionTimeoutMS=config.mongo_timeout_ms,
+            connectTimeoutMS=config.mongo_timeout_ms,
+            socketTimeoutMS=config.mongo_timeout_ms,
+        )
+    return mongo_client[config.database_name]
+
+# Field projections for the bot's queries, so MongoDB only sends the fields a
+# handler actually uses (profiles also hold bios, photos, ... for the web apps)
+USER_PROFILE_FIELDS = {
+    field: 1 for field in [
+        "telegramId", "username", "displayName", "age", "gender", "sports", "matchPreferences",
+        "wantToBeMatched", "selectedSport", "sportSearches", "isMatched",
+    ]
 }
+DISPLAY_NAME_FIELDS = {"telegramId": 1, "displayName": 1}
+CLAIM_FIELDS = {"telegramId": 1}
+DUE_SMART_MATCH_FIELDS = {"telegramId": 1, "sportSearches": 1}
+# The search fields used before searches were kept per sport, see convert_legacy_searches
+LEGACY_SEARCH_FIELDS = {
+    field: 1 for field in [
+        "selectedSport", "smartMatch", "matchStartTime",
+    ]
+}
+MATCH_PARTICIPANT_FIELDS = {"userAId": 1, "userBId": 1}
+
+# Thread pool that runs the blocking pymongo calls, created by configure()
+db_executor = None
+# Per-update MongoDB operation profiler, only created when mongo_profile is set
+mongo_profiler = None
+
+class AsyncCollection:
+    """Async wrapper around a pymongo collection.
+
+    Every call is run in db_executor so a slow MongoDB round-trip never blocks
+    the event loop (and with it every other chat's update).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._collection = None
+
+    @property
+    def collection(self):
+        # Resolved on first use, so the MongoDB client is only created when needed
+        if self._collection is None:
+            self._collection = get_database()[self.name]
+        return self._collection
+
+    @collection.setter
+    def collection(self, collection):
+        self._collection = collection
+
+    async def _run(self, operation, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(method, *args, **kwargs)
+        if not metrics_registry.enabled and mongo_profiler is None:
+            return await loop.run_in_executor(db_executor, call)
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(db_executor, call)
+        finally:
+            elapsed = time.perf_counter() - started
+            if metrics_registry.enabled:
+                metrics_registry.mongo_seconds.observe(
+                    elapsed, current_handler.get(), self.collection.name, operation
+                )
+            if mongo_profiler is not None:
+                await mongo_profiler.record(self.collection, operation, args, kwargs, elapsed)
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run("find_one", self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs):
+        # The cursor is consumed inside the worker thread, so the result is a list
+        return await self._run("find", lambda *a, **kw: list(self.collection.find(*a, **kw)), *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run("insert_one", self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._run("insert_many", self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run("update_one", self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run("update_many", self.collection.update_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._run("find_one_and_update", self.collection.find_one_and_update, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run("bulk_write", self.collection.bulk_write, *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs):
+        return await self._run("create_index", self.collection.create_index, *args, **kwargs)
+
+
+class UserCollection(AsyncCollection):
+    """AsyncCollection for users that serves telegramId lookups from a UserCache.
+
+    Every update the bot makes through it is written through to the cache
+    (or drops the cached document when the update didn't apply as expected).
+    """
+
+    def __init__(self, name, cache):
+        super().__init__(name)
+        self.cache = cache
+
+    async def find_user(self, telegram_id):
+        """Return the user's profile (USER_PROFILE_FIELDS), from the cache when possible."""
+        user = self.cache.get(telegram_id)
+        if user is None:
+            user = await self.find_one({"telegramId": telegram_id}, USER_PROFILE_FIELDS)
+            if user:
+                self.cache.put(user)
+        return user
+
+    async def find_user_fields(self, telegram_id, projection):
+        """Return a few fields of a user, from the cache if cached, without caching the result."""
+        user = self.cache.get(telegram_id)
+        if user is None:
+            user = await self.find_one({"telegramId": telegram_id}, projection)
+        return user
+
+    async def update_one(self, filter, update, **kwargs):
+        result = await super().update_one(filter, update, **kwargs)
+        self._write_through(filter, update, result.matched_count)
+        return result
+
+    async def update_many(self, filter, update, **kwargs):
+        result = await super().update_many(filter, update, **kwargs)
+        self._write_through(filter, update, result.matched_count)
+        return result
+
+    async def find_one_and_update(self, filter, update, projection=USER_PROFILE_FIELDS, **kwargs):
+        user = await super().find_one_and_update(filter, update, projection=projection, **kwargs)
+        if user is None:
+            self._write_through(filter, update, 0)
+        elif kwargs.get("return_document") == ReturnDocument.AFTER and projection is USER_PROFILE_FIELDS:
+            self.cache.put(user)
+        else:
+            self.cache.apply_update(user["telegramId"], update)
+        return user
+
+    def _write_through(self, filter, update, matched_count):
+        telegram_ids = filter.get("telegramId")
+        if isinstance(telegram_ids, dict):
+            telegram_ids = telegram_ids.get("$in")
+        elif telegram_ids is not None:
+            telegram_ids = [telegram_ids]
+        if telegram_ids is None:
+            # Not a per-user update, nothing in the cache can be trusted
+            self.cache.clear()
+            return
+        telegram_ids = set(telegram_ids)
+        for telegram_id in telegram_ids:
+            if matched_count == len(telegram_ids):
+                self.cache.apply_update(telegram_id, update)
+            else:
+                self.cache.invalidate(telegram_id)
+
+# Recently read user documents, so one conversation flow doesn't re-read the same profile
+user_cache = UserCache()
+
+users_collection = UserCollection("User", user_cache)  # Use the collection "users"
+matches_collection = AsyncCollection("Match")  # Use the collection "matches"
+feedback_collection = AsyncCollection("Feedback")  # Use the collection "Feedback"
+bot_state_collection = AsyncCollection("BotState")  # Conversation states and user_data (MongoPersistence)
+
+# Create the indexes used by the bot's queries (no-op when they already exist)
+async def ensure_indexes():
+    # Waiting pool load in load_matching_pool (on startup and every user sync poll)
+    await users_collection.create_index([("wantToBeMatched", 1), ("isMatched", 1)], name="waiting_pool")
+    # Due Smart-Match lookup in process_due_smart_matches
+    await users_collection.create_index(
+        [("sportSearches.smartMatch", 1), ("wantToBeMatched", 1), ("isMatched", 1), ("sportSearches.matchStartTime", 1)],
+        name="sport_search_due",
+    )
+    # Active match lookup for either side of a match
+    await matches_collection.create_index([("userAId", 1), ("status", 1)], name="userA_status")
+    await matches_collection.create_index([("userBId", 1), ("status", 1)], name="userB_status")
+    try:
+        await users_collection.create_index("telegramId", unique=True, name="telegramId_unique")
+    except OperationFailure as e:
+        # Existing duplicate telegramIds must be cleaned up before the index can be built
+        logger.error("Error creating unique telegramId index: %s", e)
+
+# Every message the bot sends on its own (not as a direct reply) goes through this
+# rate-limited queue, so bursts never run into Telegram's flood limits (created by configure())
+outbound = None
+
+# Feedback and rating answers are written in batches in the background, so bursts of
+# them after /endmatch don't compete with matching for MongoDB (created by configure())
+write_buffer = None
+
+# In-memory index of the users waiting for a match, per sport
+matching_engine = MatchingEngine()
+
+# Active match of each matched user, so relaying chat messages needs no database calls.
+# display_name is the user's own name as shown to their partner.
+ActivePartner = namedtuple("ActivePartner", ["partner_id", "display_name", "match_id"])
+active_partners = {}
+
+def remember_match(match_id, user_entry, potential_match):
+    active_partners[user_entry.telegram_id] = ActivePartner(potential_match.telegram_id, user_entry.display_name, match_id)
+    active_partners[potential_match.telegram_id] = ActivePartner(user_entry.telegram_id, potential_match.display_name, match_id)
+
+def forget_match(*telegram_ids):
+    for telegram_id in telegram_ids:
+        active_partners.pop(telegram_id, None)
+
+# Parsed matchPreferences per user, so the JSON is only decoded once per change
+preference_cache = PreferenceCache()
+
+# Drop everything cached about a user, e.g. after their profile was edited in a web app
+def invalidate_user(telegram_id):
+    user_cache.invalidate(telegram_id)
+    preference_cache.invalidate(telegram_id)
+
+# Give the users who were already searching before searches were kept per sport their
+# sportSearches (a no-op once every such search is converted)
+async def convert_legacy_searches():
+    legacy_users = await users_collection.find(
+        {"wantToBeMatched": True, "isMatched": False, "sportSearches": {"$exists": False}},
+        {"telegramId": 1, **LEGACY_SEARCH_FIELDS}
+    )
+    requests = []
+    for user in legacy_users:
+        searches = []
+        if user.get("selectedSport"):
+            searches.append({
+                "sport": user["selectedSport"],
+                "smartMatch": user.get("smartMatch", False),
+                "smartMatchStage": 0,
+                "matchStartTime": user.get("matchStartTime"),
+            })
+        requests.append(UpdateOne(
+            {"_id": user["_id"], "sportSearches": {"$exists": False}},
+            {"$set": {"sportSearches": searches}}
+        ))
+    if requests:
+        await users_collection.bulk_write(requests, ordered=False)
+        user_cache.clear()
+        logger.info("Converted the searches of %d users to per-sport searches", len(requests))
+
+# Rebuild the in-memory waiting pool from MongoDB (the source of truth). The pool is
+# only updated once the read is done, so searches never see it empty in the meantime.
+async def load_matching_pool():
+    waiting_users = await users_collection.find({"wantToBeMatched": True, "isMatched": False}, USER_PROFILE_FIELDS)
+    matching_engine.load(
+        waiting_entry(user, sport) for user in waiting_users for sport in searching_sports(user)
+    )
+    return len(waiting_users)
+
+# Bring the in-process caches and the waiting pool up to date with a user document
+# that changed in MongoDB (edited in a web app, or written by another bot process)
+def apply_user_change(user):
+    telegram_id = user["telegramId"]
+    preference_cache.invalidate(telegram_id)
+    user_cache.refresh(user)
+    sports = []
+    if user.get("wantToBeMatched", False) and not user.get("isMatched", False):
+        sports = searching_sports(user)
+    for sport in matching_engine.waiting_sports(telegram_id).difference(sports):
+        matching_engine.remove(telegram_id, sport)
+    for sport in sports:
+        matching_engine.add(waiting_entry(user, sport))
+    if not user.get("isMatched", False):
+        forget_match(telegram_id)
+
+# Called on the event loop for every change stream event
+def apply_database_change(change):
+    document = change.get("fullDocument")
+    if not document:
+        return  # Deleted before the lookup
+    if change["ns"]["coll"] == "User" and "telegramId" in document:
+        apply_user_change(document)
+    elif change["ns"]["coll"] == "Match" and document.get("status") != "active":
+        forget_match(document.get("userAId"), document.get("userBId"))
+
+# Fallback when change streams are unavailable (standalone MongoDB): periodically
+# reload the waiting pool and re-read every user the bot holds state for
+async def poll_user_changes(context: ContextTypes.DEFAULT_TYPE):
+    await load_matching_pool()
+    telegram_ids = list(set(user_cache.entries) | set(active_partners))
+    for start in range(0, len(telegram_ids), 1000):
+        batch = telegram_ids[start:start + 1000]
+        users = await users_collection.find({"telegramId": {"$in": batch}}, USER_PROFILE_FIELDS)
+        for user in users:
+            apply_user_change(user)
+        for telegram_id in set(batch) - {user["telegramId"] for user in users}:
+            invalidate_user(telegram_id)
+            forget_match(telegram_id)
+
+# Change stream listener, None when polling instead
+change_listener = None
+
+# Start following MongoDB changes, falling back to polling if the server can't stream them
+async def start_state_sync(application):
+    global change_listener
+    from state_sync import ChangeStreamListener
+
+    loop = asyncio.get_running_loop()
+    change_listener = ChangeStreamListener(
+        get_database(),
+        loop,
+        collections=["User", "Match"],
+        fields=list(USER_PROFILE_FIELDS) + ["userAId", "userBId", "status"],
+        on_change=apply_database_change
+    )
+    change_listener.start()
+    await loop.run_in_executor(None, change_listener.started.wait, config.mongo_timeout_ms / 1000)
+    if change_listener.supported:
+        logger.info("Following user changes through a MongoDB change stream")
+        return
+    logger.info("Change streams unavailable, polling for user changes instead")
+    change_listener.stop()
+    change_listener = None
+    application.job_queue.run_repeating(
+        metrics_registry.instrumented(poll_user_changes),
+        interval=config.user_sync_poll_interval,
+        first=config.user_sync_poll_interval,
+        name="poll_user_changes"
+    )
+
+# Queue depths, pool sizes and cache statistics, read when /metrics is scraped
+metrics_registry.register(Gauge(
+    "sportsfinder_outbound_queue_depth", "Messages waiting in the outbound dispatcher",
+    lambda: {(): outbound.queue_depth}))
+metrics_registry.register(CollectedCounter(
+    "sportsfinder_outbound_messages_total", "Outbound messages by result since startup",
+    lambda: {(result,): count for result, count in outbound.metrics.items()}, ("result",)))
+metrics_registry.register(Gauge(
+    "sportsfinder_write_buffer_pending", "Feedback writes waiting to be written",
+    lambda: {(): write_buffer.pending}))
+metrics_registry.register(Gauge(
+    "sportsfinder_update_queue_depth", "Telegram updates waiting to be processed",
+    lambda: {(): application.update_queue.qsize()}))
+metrics_registry.register(Gauge(
+    "sportsfinder_matching_pool_size", "Users waiting for a match",
+    lambda: {(sport,): len(pool) for sport, pool in matching_engine.pools.items()}, ("sport",)))
+metrics_registry.register(Gauge(
+    "sportsfinder_user_cache", "User cache size and lookups since startup",
+    lambda: {("size",): len(user_cache), ("hits",): user_cache.hits, ("misses",): user_cache.misses}, ("stat",)))
+
+metrics_server = None
+
+# Serve the metrics for Prometheus; webhook workers each listen on metrics_port + their index
+async def start_metrics_server(application):
+    global metrics_server
+
+    async def render_metrics(headers, body):
+        return 200, metrics_registry.render()
+
+    port = config.metrics_port + application.bot_data.get("worker_index", 0)
+    metrics_server = asyncio.create_task(serve_http({("GET", "/metrics"): render_metrics}, config.metrics_host, port))
+    logger.info("Serving metrics on port %d", port)
+
+# Prepare the database and the matching pool before the bot starts polling
+async def on_startup(application):
+    outbound.start(application.bot)
+    write_buffer.start()
+    await ensure_indexes()
+    await convert_legacy_searches()
+    logger.info("Loaded %d waiting users into the matching pool", await load_matching_pool())
+
+    # Keep caches and the waiting pool in sync with edits made by the web apps
+    # and by other bot processes
+    await start_state_sync(application)
+    if metrics_registry.enabled:
+        await start_metrics_server(application)
+
+    # The background matching jobs only need to run in one process
+    if application.bot_data.get("worker_index", 0) != 0:
+        return
+
+    # Runs immediately, so Smart-Matches that fell due while the bot was down are picked up
+    application.job_queue.run_repeating(
+        metrics_registry.instrumented(process_due_smart_matches),
+        interval=config.smart_match_poll_interval,
+        first=0,
+        name="smart_match_due"
+    )
+    application.job_queue.run_repeating(
+        metrics_registry.instrumented(matching_sweep),
+        interval=config.matching_sweep_interval,
+        first=config.matching_sweep_interval,
+        name="matching_sweep"
+    )
+
+# Release the MongoDB worker threads and connections when the bot stops (after
+# shutdown() has flushed the persistence)
+async def on_shutdown(application):
+    if metrics_server:
+        metrics_server.cancel()
+    if change_listener:
+        change_listener.stop()
+    db_executor.shutdown(wait=True)
+    if mongo_client is not None:
+        mongo_client.close()
+
+class UserOrderedApplication(Application):
+    """Application that processes updates concurrently, but one at a time per user.
+
+    A user's /matchme, sport_ and smartmatch_ updates therefore still run in the
+    order they were sent, while updates from different users run in parallel.
+    At most max_concurrent_updates are processed at the same time; the slot is
+    only taken once the user's lock is held, so updates queued behind another
+    update of the same user don't keep other users waiting.
+    """
+
+    def __init__(self, max_concurrent_updates, **kwargs):
+        super().__init__(**kwargs)
+        # A lock only lives while some update of that user holds or waits for it
+        self.user_locks = weakref.WeakValueDictionary()
+        self.update_slots = asyncio.Semaphore(max_concurrent_updates or 1)
+
+    async def process_update(self, update):
+        if mongo_profiler is None:
+            await self.process_update_in_order(update)
+            return
+        label = f"update {update.update_id}" if isinstance(update, Update) else type(update).__name__
+        with mongo_profiler.profile(label):
+            await self.process_update_in_order(update)
+
+    async def stop(self):
+        await super().stop()
+        # Deliver the messages still queued while the bot can send them (shutdown() closes it)
+        await outbound.stop()
+        await write_buffer.stop()
+
+    async def process_update_in_order(self, update):
+        user_key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                user_key = update.effective_user.id
+            elif update.effective_chat:
+                user_key = update.effective_chat.id
+        if user_key is None:
+            async with self.update_slots:
+                await super().process_update(update)
+            return
+
+        lock = self.user_locks.get(user_key)
+        if lock is None:
+            lock = self.user_locks[user_key] = asyncio.Lock()
+        async with lock, self.update_slots:
+            await super().process_update(update)
+
+# The Telegram Bot application, built by create_app()
+application = None
 
 SMART_MATCH_WAIT_TIME = 60  # 1 hour in seconds (this is in seconds)
 
+# Smart-Match relaxation stage s is reached after s / FULLY_RELAXED of SMART_MATCH_WAIT_TIME,
+# so preferences open up one at a time and are fully relaxed after SMART_MATCH_WAIT_TIME
+def smart_match_stage_delay(stage):
+    return datetime.timedelta(seconds=SMART_MATCH_WAIT_TIME * stage / FULLY_RELAXED)
+
+# The relaxation stage a Smart-Match search that started at match_start_time has reached by now
+def due_smart_match_stage(match_start_time, now):
+    stage = 0
+    while stage < FULLY_RELAXED and match_start_time <= now - smart_match_stage_delay(stage + 1):
+        stage += 1
+    return stage
+
 # Function to handle /start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
@@ -52,32 +535,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_username = update.message.from_user.username or "Unknown"
 
     # Check if the user exists in MongoDB
-    existing_user = users_collection.find_one({"telegramId": user_telegram_id})
+    existing_user = await users_collection.find_user(user_telegram_id)
 
     if not existing_user:
-        # First-time user
-        welcome_message = (
-            f"Welcome to SportsFinder!\n\n"
-            "This is a player matching service for your favourite sports. "
-            "To begin, click on the button below to open our web app - "
-            "it’ll give you access to view and edit your profile from there!"
-        )
-
-        # Create the web app button for first-time users
-        keyboard = [[InlineKeyboardButton("My Profile", web_app={'url': 'https://test-webapp-sportsfinder.vercel.app/'})]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Send the welcome message with the button
+        # First-time user: send the welcome message with the web app button
         await update.message.reply_text(
-            welcome_message,
-            reply_markup=reply_markup
+            templates.WELCOME_NEW_USER,
+            reply_markup=templates.WELCOME_KEYBOARD
         )
     else:
         # Returning user
-        welcome_message = (
-            f"Welcome back, {user_first_name}!\n\n"
-            "SportsFinder is a player matching bot for your favourite sports! Click the commands below to edit your profile or match preferences! "
-        )
+        welcome_message = templates.WELCOME_BACK.format(first_name=user_first_name)
 
         # Send the welcome message without any buttons
         await update.message.reply_text(welcome_message)
@@ -89,27 +557,15 @@ async def edit_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
 
     # Fetch the user's document from MongoDB
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
     # Use the displayName from MongoDB, or fallback to first_name if not available
     user_display_name = user.get("displayName", update.message.from_user.first_name or "Unknown")
 
     
-    # Craft the message with a personalized greeting and the web app button
-    edit_profile_message = (
-        f"Hi {user_display_name}! Click on the respective buttons below to edit bio or match preferences!"
-    )
-    
-    # Create the web app button for editing profile
-    keyboard = [
-        [InlineKeyboardButton("Edit Profile", web_app={'url': 'https://test-webapp-profile-sportsfinder.vercel.app/'})],
-        [InlineKeyboardButton("Edit Match Preferences", web_app={'url': 'https://test-webapp-matchpreferences-sportsfinder.vercel.app/'})]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    # Send the message with the button
+    # Send a personalized greeting with the web app buttons for editing the profile
     await update.message.reply_text(
-        edit_profile_message,
-        reply_markup=reply_markup
+        templates.EDIT_PROFILE.format(display_name=user_display_name),
+        reply_markup=templates.EDIT_PROFILE_KEYBOARD
     )
 
 # Function to handle /matchpreferences command
@@ -117,26 +573,16 @@ async def match_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_first_name = update.message.from_user.first_name or "Unknown"
     user_username = update.message.from_user.username or "Unknown"
 
-    # Create a message for the user with a link to the web app to view/edit their match preferences
-    message = (
-        f"Hi {user_first_name}, you can click on the button below to open the web app! "
-        "It’ll give you access to view and edit your match preferences from there!"
-    )
-
-    # Create the web app button
-    keyboard = [[InlineKeyboardButton("Edit Match Preferences", web_app={'url': 'https://webapp-matchpreferences-sportsfinder.vercel.app/'})]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    # Send the message with the button
+    # Send the user a link to the web app to view/edit their match preferences
     await update.message.reply_text(
-        message,
-        reply_markup=reply_markup
+        templates.MATCH_PREFERENCES.format(first_name=user_first_name),
+        reply_markup=templates.MATCH_PREFERENCES_KEYBOARD
     )
 
 # /matchme function
 async def match_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
 
     if not user:
         await update.message.reply_text("Please complete your profile first!")
@@ -164,65 +610,73 @@ async def match_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("You have not selected any sports in your profile!")
         return
 
-    # Create inline buttons for each sport
-    keyboard = [
-        [InlineKeyboardButton(sport, callback_data=f"sport_{sport}")] for sport in selected_sports
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    # Ask the user which sport they want to find a match for
+    # Ask the user which sport they want to find a match for, with a button for each sport
     await update.message.reply_text(
-        "Ready for your next game? Which sport are you looking to find a player for:",
-        reply_markup=reply_markup
+        templates.CHOOSE_SPORT,
+        reply_markup=templates.sport_keyboard(tuple(selected_sports))
     )
 
 # Modify the sport_selected function to ask about Smart-Match
-async def sport_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def sport_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
 
-    sport = query.data.split("_")[1]  # Extract the selected sport
+    sport = data.sport  # The selected sport
     user_telegram_id = query.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
 
     if not user:
         await query.edit_message_text("User not found.")
         return
     
     # Ask about Smart-Match
-    smart_match_keyboard = [
-        [InlineKeyboardButton("On", callback_data=f"smartmatch_on_{sport}")],
-        [InlineKeyboardButton("Off", callback_data=f"smartmatch_off_{sport}")]
-    ]
-    smart_match_markup = InlineKeyboardMarkup(smart_match_keyboard)
-    
     await query.edit_message_text(
-        f"Do you want Smart-Match on for {sport}?\n\n"
-        "If no one is found within 1 hour, your match preference opens up to all options until you find a match.",
-        reply_markup=smart_match_markup
+        templates.SMART_MATCH_QUESTION.format(sport=sport),
+        reply_markup=templates.smart_match_keyboard(sport)
     )
 
     # Add new callback handler for Smart-Match response
-async def smart_match_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def smart_match_response(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()
     
-    data = query.data
-    _, smart_match_setting, sport = data.split("_")
+    smart_match_setting = "on" if data.value else "off"
+    sport = data.sport
     user_telegram_id = query.from_user.id
     
-    # Update user's Smart-Match preference and start time
-    users_collection.update_one(
-        {"telegramId": user_telegram_id},
-        {
-            "$set": {
-                "wantToBeMatched": True,
-                "selectedSport": sport,
-                "smartMatch": smart_match_setting == "on",
-                "matchStartTime": datetime.datetime.now()
-            }
-        }
+    # Every sport has its own Smart-Match setting, start time and relaxation stage
+    # (selectedSport is kept as the most recently chosen sport, for readers of the old field)
+    search = {
+        "sport": sport,
+        "smartMatch": smart_match_setting == "on",
+        "smartMatchStage": 0,
+        "matchStartTime": datetime.datetime.now()
+    }
+    searching = {"telegramId": user_telegram_id, "wantToBeMatched": True, "isMatched": False}
+    # Restart the search for this sport if the user is already searching for it...
+    user = await users_collection.find_one_and_update(
+        {**searching, "sportSearches.sport": sport},
+        {"$set": {"sportSearches.$": search, "selectedSport": sport}},
+        return_document=ReturnDocument.AFTER
     )
+    if not user:
+        # ...or add it to the sports the user is searching for, leaving those unchanged...
+        user = await users_collection.find_one_and_update(
+            {**searching, "sportSearches": {"$exists": True}, "sportSearches.sport": {"$ne": sport}},
+            {"$push": {"sportSearches": search}, "$set": {"selectedSport": sport}},
+            return_document=ReturnDocument.AFTER
+        )
+    if not user:
+        # ...or start a new search with just this sport
+        user = await users_collection.find_one_and_update(
+            {"telegramId": user_telegram_id},
+            {"$set": {"wantToBeMatched": True, "selectedSport": sport, "sportSearches": [search]}},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    # Add (or update) the user in this sport's waiting pool
+    if user and not user.get("isMatched", False):
+        matching_engine.add(waiting_entry(user, sport))
     
     await query.edit_message_text(
         f"Got it! Smart-Match is turned {smart_match_setting} for {sport}. "
@@ -234,198 +688,341 @@ async def smart_match_response(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # Modified matching function
 async def find_match(user_telegram_id, sport, context, is_smart_match):
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
     
     if not user:
-        await context.bot.send_message(
+        outbound.send_message(
             chat_id=user_telegram_id,
             text="User not found."
         )
         return
     
     # First try to find a match with preferences
-    match_found = await try_find_match(user_telegram_id, sport, context, use_preferences=True)
+    match_found = await try_find_match(user_telegram_id, sport, context)
     
     if not match_found and is_smart_match:
-        # If no match found and Smart-Match is on, schedule a check for later
-        context.job_queue.run_once(
-            smart_match_check,
-            SMART_MATCH_WAIT_TIME,
+        # If no match found and Smart-Match is on, process_due_smart_matches relaxes
+        # the user's preferences step by step as time passes since matchStartTime
+        outbound.send_message(
             chat_id=user_telegram_id,
-            name=f"smartmatch_{user_telegram_id}",
-            data={
-                "sport": sport,
-                "start_time": datetime.datetime.now()
-            }
-        )
-        
-        await context.bot.send_message(
-            chat_id=user_telegram_id,
-            text=f"No match found for {sport} at the moment. Please hang tight! If we can’t find a suitable match within an hour, we’ll try again with more flexible preferences."
+            text=f"No match found for {sport} at the moment. Please hang tight! If we can’t find a suitable match, we’ll gradually open up your preferences over the next hour."
         )
 
-# Background job for Smart-Match check
-async def smart_match_check(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_telegram_id = job.chat_id
-    sport = job.data["sport"]
-    start_time = job.data["start_time"]
+# Background job that moves the searches of Smart-Match users on to the next relaxation
+# stage when it is due. Due times are derived from matchStartTime in MongoDB, so
+# pending Smart-Matches survive restarts and are picked up on the first run.
+async def process_due_smart_matches(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.datetime.now()
+    due_users = await users_collection.find(
+        {
+            "wantToBeMatched": True,
+            "isMatched": False,
+            # Users with a Smart-Match search whose next stage is due
+            "$or": [
+                {"sportSearches": {"$elemMatch": {
+                    "smartMatch": True,
+                    "smartMatchStage": {"$lt": stage},
+                    "matchStartTime": {"$lte": now - smart_match_stage_delay(stage)}
+                }}}
+                for stage in range(1, FULLY_RELAXED + 1)
+            ]
+        },
+        DUE_SMART_MATCH_FIELDS,
+        sort=[("sportSearches.matchStartTime", 1)],
+        limit=config.smart_match_batch_size
+    )
+    await asyncio.gather(*(smart_match_check(user, context) for user in due_users))
+
+# Smart-Match check for a single due user
+async def smart_match_check(user, context: ContextTypes.DEFAULT_TYPE):
+    user_telegram_id = user["telegramId"]
+    now = datetime.datetime.now()
     
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    # Move each of the user's due Smart-Match searches on to the stage due now. A search whose
+    # check was delayed (e.g. by a restart) skips straight to that stage. The stage is claimed
+    # first, so it is only processed once even if several bot processes run this job at the same time.
+    advanced = {}  # stage -> sports
+    claimed = None
+    for search in user.get("sportSearches", []):
+        if not search.get("smartMatch") or not search.get("matchStartTime"):
+            continue
+        stage = due_smart_match_stage(search["matchStartTime"], now)
+        if stage <= search.get("smartMatchStage", 0):
+            continue
+        updated = await users_collection.find_one_and_update(
+            {
+                "telegramId": user_telegram_id,
+                "wantToBeMatched": True,
+                "isMatched": False,
+                "sportSearches": {"$elemMatch": {
+                    "sport": search["sport"],
+                    "smartMatch": True,
+                    "matchStartTime": search["matchStartTime"],
+                    "smartMatchStage": {"$lt": stage}
+                }}
+            },
+            {"$set": {"sportSearches.$.smartMatchStage": stage}},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated:
+            claimed = updated
+            advanced.setdefault(stage, []).append(search["sport"])
     
-    if not user or not user.get("wantToBeMatched", False) or user.get("isMatched", False):
-        return  # User is no longer looking for a match
+    if not claimed:
+        return  # User is no longer looking for a match, or was already processed
     
-    # Check if user still has Smart-Match on
-    if not user.get("smartMatch", False):
-        await context.bot.send_message(
-            chat_id=user_telegram_id,
-            text=f"Smart-Match is no longer active for {sport}."
-        )
-        return
+    # From now on the matching sweep also searches for this user with the relaxed preferences
+    for sports in advanced.values():
+        for sport in sports:
+            matching_engine.add(waiting_entry(claimed, sport))
 
-    # Notify user that preferences are being loosened!
-    await context.bot.send_message(
-        chat_id=user_telegram_id,
-        text=f"⏳ Couldn't find a strict match for {sport} after 1 hour. Now expanding search to all available players with Smart-Match ON!"
-    )
-    
-    # Try to find a match without considering preferences
-    await try_find_match(user_telegram_id, sport, context, use_preferences=False)
+    try:
+        # Notify user that preferences are being loosened!
+        for stage, sports in advanced.items():
+            outbound.send_message(
+                chat_id=user_telegram_id,
+                text=templates.SMART_MATCH_STAGES[stage].format(sports=", ".join(sports))
+            )
+        
+        # Try to find a match with the relaxed preferences, one sport after the other
+        for sports in advanced.values():
+            for sport in sports:
+                if await try_find_match(user_telegram_id, sport, context):
+                    return
+    except Exception as e:
+        logger.exception("Error in smart_match_check for user %s", user_telegram_id)
 
 # Unified matching function
-async def try_find_match(user_telegram_id, sport, context, use_preferences=True):
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+async def try_find_match(user_telegram_id, sport, context):
+    user = await users_collection.find_user(user_telegram_id)
     
     if not user:
         return False
     
-    if use_preferences:
-        # Get user's preferences for the sport
-        match_preferences = user.get("matchPreferences", {})
-        if isinstance(match_preferences, str):
-            try:
-                match_preferences = json.loads(match_preferences)
-            except json.JSONDecodeError:
-                match_preferences = {}
-        
-        sport_preferences = match_preferences.get(sport, {})
-        age_range = sport_preferences.get("ageRange", [1, 100])
-        gender_preference = sport_preferences.get("genderPreference", "No preference")
-        skill_levels = sport_preferences.get("skillLevels", [])
-        location_preferences = set(sport_preferences.get("locationPreferences", []))
-    else:
-        # For Smart-Match, use very broad preferences
-        age_range = [1, 100]
-        gender_preference = "No preference"
-        skill_levels = []
-        location_preferences = set()
-    
-    # Find potential matches
-    query = {
-        "telegramId": {"$ne": user_telegram_id},
-        "wantToBeMatched": True,
-        "selectedSport": sport,
-        "isMatched": False,
-        "smartMatch": True
-    }
+    # Look up the users who mutually accept this user (at their Smart-Match stage) in the in-memory waiting pool
+    user_entry = waiting_entry(user, sport)
+    candidates = matching_engine.find_candidates(user_entry, limit=config.match_candidates)
     
-    for potential_match in users_collection.find(query):
-        # Check if we should consider preferences
-        if use_preferences:
-            # Get potential match's preferences for the sport
-            potential_match_preferences = potential_match.get("matchPreferences", {})
-            if isinstance(potential_match_preferences, str):
-                try:
-                    potential_match_preferences = json.loads(potential_match_preferences)
-                except json.JSONDecodeError:
-                    potential_match_preferences = {}
-            
-            potential_sport_preferences = potential_match_preferences.get(sport, {})
-            potential_location_preferences = set(potential_sport_preferences.get("locationPreferences", []))
-            
-            # Check if potential match would accept this user
-            potential_age_range = potential_sport_preferences.get("ageRange", [1, 100])
-            potential_gender_preference = potential_sport_preferences.get("genderPreference", "No preference")
-            potential_skill_levels = potential_sport_preferences.get("skillLevels", [])
-            
-            # Get user's data
-            user_age = int(user.get("age", 0))
-            user_gender = user.get("gender")
-            user_sports = user.get("sports", {})
-            user_skill_level = user_sports.get(sport, "Unknown")
-            
-            # Check if potential match would accept this user
-            potential_gender_condition = (potential_gender_preference in ["No preference", "Either"] or 
-                                        user_gender == potential_gender_preference)
-            potential_age_condition = (potential_age_range[0] <= user_age <= potential_age_range[1])
-            potential_skill_condition = (not potential_skill_levels or 
-                                       user_skill_level in potential_skill_levels)
-            
-            if not (potential_gender_condition and potential_age_condition and potential_skill_condition):
-                continue  # Skip if potential match wouldn't accept this user
+    for potential_match in candidates:
+        # Atomically claim both users so concurrent searches can't double-book them
+        lost_user_id, claimed_users = await claim_pair(user_telegram_id, potential_match.telegram_id, sport)
+        if lost_user_id == potential_match.telegram_id:
+            # Someone else claimed this candidate first (or they stopped searching for this sport), try the next one
+            await refresh_waiting_user(potential_match.telegram_id)
+            continue
+        if lost_user_id == user_telegram_id:
+            # This user was claimed by a concurrent search (or stopped searching for this sport);
+            # their waiting entry follows whatever happens to that claim
+            return False
         
-        # Get potential match's data
-        potential_match_age = int(potential_match.get("age", 0))
-        potential_match_gender = potential_match.get("gender")
-        potential_match_sports = potential_match.get("sports", {})
-        potential_match_skill_level = potential_match_sports.get(sport, "Unknown")
-        
-        # Check if user would accept this match (only when using preferences)
-        if use_preferences:
-            gender_condition = (gender_preference in ["No preference", "Either"] or 
-                              potential_match_gender == gender_preference)
-            age_condition = (age_range[0] <= potential_match_age <= age_range[1])
-            skill_condition = (not skill_levels or 
-                             potential_match_skill_level in skill_levels)
-            location_condition = (not location_preferences or 
-                                len(location_preferences.intersection(potential_location_preferences)) > 0)
-            
-            if not (gender_condition and age_condition and skill_condition and location_condition):
-                continue  # Skip if user wouldn't accept this match
+        # If we get here, we have a match! The id is set here, so it is known whatever happens to the insert
+        new_match = {"_id": ObjectId(), **new_match_document(user_entry, potential_match)}
+        try:
+            await matches_collection.insert_one(new_match)
+        except BaseException:
+            # Without a Match document the users could never end the match, put them back
+            await end_failed_matches([new_match["_id"]])
+            await release_users(claimed_users)
+            raise
         
-        # If we get here, we have a match!
-        match_document = {
-            "userAId": user_telegram_id,
-            "userBId": potential_match["telegramId"],
-            "userAUsername": user.get("username", "Unknown"),
-            "userBUsername": potential_match.get("username", "Unknown"),
-            "sport": sport,
-            "status": "active",
-            "usedSmartMatch": not use_preferences  # Track if this was a Smart-Match
-        }
-        matches_collection.insert_one(match_document)
+        # Neither user is waiting any more, in any sport
+        matching_engine.remove(user_telegram_id)
+        matching_engine.remove(potential_match.telegram_id)
+        remember_match(new_match["_id"], user_entry, potential_match)
         
-        # Update both users
-        users_collection.update_many(
-            {"telegramId": {"$in": [user_telegram_id, potential_match["telegramId"]]}},
-            {"$set": {"isMatched": True, "wantToBeMatched": False, "smartMatch": False}}
-        )
+        await notify_match(context, user_entry, potential_match)
+        return True
+    
+    return False
+
+# Build the Match document for two claimed users
+def new_match_document(user_entry, potential_match):
+    return {
+        "userAId": user_entry.telegram_id,
+        "userBId": potential_match.telegram_id,
+        "userAUsername": user_entry.username,
+        "userBUsername": potential_match.username,
+        "sport": user_entry.sport,
+        "status": "active",
+        "usedSmartMatch": user_entry.stage > 0,  # Track if this was a Smart-Match
+        "smartMatchStage": user_entry.stage  # ...and how far the preferences were relaxed
+    }
+
+# Notify both users of a new match
+async def notify_match(context, user_entry, potential_match):
+    sport = user_entry.sport
+    used_smart_match = user_entry.stage > 0
+    outbound.send_message(
+        chat_id=user_entry.telegram_id,
+        text=f"You have been matched with {potential_match.display_name} "
+             f"({potential_match.age}, {potential_match.gender}) for {sport}! 🎉\n"
+             f"You can now start chatting via this bot, type your messages below!"
+    )
+    
+    outbound.send_message(
+        chat_id=potential_match.telegram_id,
+        text=f"You have been matched with {user_entry.display_name} "
+             f"({user_entry.age}, {user_entry.gender}) for {sport}! 🎉\n"
+             f"You can now start chatting via this bot, type your messages below!" +
+             ("\n\nNote: This match was made with relaxed preferences using Smart-Match." if used_smart_match else "")
+    )
+
+SWEEP_SLICE_SECONDS = 0.05  # Longest the matching sweep searches before yielding to the event loop
+
+# Background job that re-runs matching for the waiting users whose searches changed since
+# the last sweep, so users who found nobody when they searched are matched as soon as a
+# suitable player exists. It yields to the event loop every SWEEP_SLICE_SECONDS, so updates
+# are still handled while a large pool is swept (e.g. the first sweep after startup).
+async def matching_sweep(context: ContextTypes.DEFAULT_TYPE):
+    for sport in list(matching_engine.pools):
+        pairs = []
+        slice_started = time.perf_counter()
+        for user_entry, potential_match in matching_engine.iter_pairs(sport):
+            if potential_match is not None:
+                pairs.append((user_entry, potential_match))
+            if time.perf_counter() - slice_started >= SWEEP_SLICE_SECONDS:
+                await asyncio.sleep(0)
+                slice_started = time.perf_counter()
+        await asyncio.sleep(0)
+        if not pairs:
+            continue
         
-        # Notify both users
-        await context.bot.send_message(
-            chat_id=user_telegram_id,
-            text=f"You have been matched with {potential_match.get('displayName', 'Unknown')} "
-                 f"({potential_match_age}, {potential_match_gender}) for {sport}! 🎉\n"
-                 f"You can now start chatting via this bot, type your messages below!"
+        # Claim every pair concurrently; pairs that lose a race are skipped this round
+        # (claim_pair releases a pair itself when one of its claims raises)
+        claim_results = await asyncio.gather(
+            *(claim_pair(user_entry.telegram_id, potential_match.telegram_id, sport) for user_entry, potential_match in pairs),
+            return_exceptions=True
         )
+        matched_pairs = []
+        matched_claims = []
+        for (user_entry, potential_match), claim_result in zip(pairs, claim_results):
+            if isinstance(claim_result, BaseException):
+                logger.error(
+                    "Error claiming users %s and %s", user_entry.telegram_id, potential_match.telegram_id,
+                    exc_info=claim_result
+                )
+                matching_engine.mark_changed(user_entry.telegram_id, sport)
+                matching_engine.mark_changed(potential_match.telegram_id, sport)
+                continue
+            lost_user_id, claimed_users = claim_result
+            if lost_user_id is not None:
+                # The local pool was out of date for this user, the other one searches again next sweep
+                await refresh_waiting_user(lost_user_id)
+                for telegram_id in (user_entry.telegram_id, potential_match.telegram_id):
+                    if telegram_id != lost_user_id:
+                        matching_engine.mark_changed(telegram_id, sport)
+                continue
+            matched_pairs.append((user_entry, potential_match))
+            matched_claims.append(claimed_users)
+        if not matched_pairs:
+            continue
         
-        await context.bot.send_message(
-            chat_id=potential_match["telegramId"],
-            text=f"You have been matched with {user.get('displayName', 'Unknown')} "
-                 f"({user_age}, {user_gender}) for {sport}! 🎉\n"
-                 f"You can now start chatting via this bot, type your messages below!" +
-                 ("\n\nNote: This match was made with relaxed preferences using Smart-Match." if not use_preferences else "")
-        )
+        # The ids are set here, so they are known whatever happens to the insert
+        new_matches = [
+            {"_id": ObjectId(), **new_match_document(user_entry, potential_match)}
+            for user_entry, potential_match in matched_pairs
+        ]
+        try:
+            await matches_collection.insert_many(new_matches, ordered=False)
+            failed = set()
+        except BulkWriteError as e:
+            # With ordered=False the other Match documents were still written
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            logger.error("Error creating %d of %d matches for %s", len(failed), len(new_matches), sport)
+        except Exception:
+            # Unknown which Match documents were written: end any that were and put everyone back
+            logger.exception("Error creating %d matches for %s", len(new_matches), sport)
+            failed = set(range(len(new_matches)))
+            await end_failed_matches([new_match["_id"] for new_match in new_matches])
+        # Without a Match document the users could never end the match, put them back
+        await release_users([user for index in sorted(failed) for user in matched_claims[index]])
+        for index in failed:
+            user_entry, potential_match = matched_pairs[index]
+            matching_engine.mark_changed(user_entry.telegram_id, sport)
+            matching_engine.mark_changed(potential_match.telegram_id, sport)
         
-        return True
-    
-    return False
+        for index, ((user_entry, potential_match), new_match) in enumerate(zip(matched_pairs, new_matches)):
+            if index in failed:
+                continue
+            matching_engine.remove(user_entry.telegram_id)
+            matching_engine.remove(potential_match.telegram_id)
+            remember_match(new_match["_id"], user_entry, potential_match)
+            try:
+                await notify_match(context, user_entry, potential_match)
+            except Exception as e:
+                logger.exception("Error notifying match for users %s and %s", user_entry.telegram_id, potential_match.telegram_id)
+        logger.info("Matching sweep created %d matches for %s", len(matched_pairs) - len(failed), sport)
+
+# Atomically mark a waiting user as matched, returns the user's previous document
+# (or None if they were already matched or are no longer searching for this sport).
+# Being matched in one sport ends the user's search in all their other sports too.
+async def claim_user(telegram_id, sport, require_smart_match=False):
+    query = {
+        "telegramId": telegram_id,
+        "wantToBeMatched": True,
+        "isMatched": False,
+        "sportSearches": {"$elemMatch": {"sport": sport, "smartMatch": True} if require_smart_match else {"sport": sport}}
+    }
+    return await users_collection.find_one_and_update(
+        query,
+        {"$set": {"isMatched": True, "wantToBeMatched": False}},
+        projection=CLAIM_FIELDS
+    )
+
+# Put a claimed user back into the waiting pool
+async def release_user(claimed_user):
+    await users_collection.update_one(
+        {"telegramId": claimed_user["telegramId"], "isMatched": True},
+        {"$set": {"isMatched": False, "wantToBeMatched": True}}
+    )
+
+# Put claimed users back into the waiting pool after their match could not be created
+async def release_users(claimed_users):
+    for claimed_user in claimed_users:
+        try:
+            await release_user(claimed_user)
+            await refresh_waiting_user(claimed_user["telegramId"])
+        except Exception:
+            logger.exception("Error releasing claimed user %s", claimed_user["telegramId"])
+
+# Re-read a user whose claim failed or was released, so their waiting entries match the database again
+async def refresh_waiting_user(telegram_id):
+    user = await users_collection.find_user(telegram_id)
+    if user:
+        apply_user_change(user)
+    else:
+        matching_engine.remove(telegram_id)
+
+# End Match documents whose insert failed, in case the server wrote them anyway
+async def end_failed_matches(match_ids):
+    try:
+        await matches_collection.update_many({"_id": {"$in": match_ids}}, {"$set": {"status": "ended"}})
+    except Exception:
+        logger.exception("Error ending possibly created matches %s", match_ids)
+
+# Claim a searching user and a candidate for a match.
+# Returns (None, claimed user documents) if both were claimed, otherwise the
+# telegramId that could not be claimed (and nothing stays claimed).
+async def claim_pair(user_telegram_id, candidate_telegram_id, sport):
+    claimed_users = []
+    try:
+        # Always claim in telegramId order, so two searches racing for the same
+        # pair can't each end up holding one half of it
+        for telegram_id in sorted([user_telegram_id, candidate_telegram_id]):
+            claimed_user = await claim_user(telegram_id, sport, require_smart_match=telegram_id == candidate_telegram_id)
+            if not claimed_user:
+                await release_users(claimed_users)
+                return telegram_id, []
+            claimed_users.append(claimed_user)
+    except BaseException:
+        await release_users(claimed_users)
+        raise
+    return None, claimed_users
 
 # Handler for /endsearch command
 async def end_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
     
     if not user:
         await update.message.reply_text("Please complete your profile first!")
@@ -441,53 +1038,50 @@ async def end_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("You are not currently searching for any matches.")
         return
     
-    # Get the sports the user is currently searching for (as string)
-    sports_selected_str = user.get("selectedSport", "")
-    
-    # Debug logging for sportsSelected
-    print(f"[DEBUG] sportsSelected value: {sports_selected_str}")  # Log the value
-    print(f"[DEBUG] sportsSelected type: {type(sports_selected_str)}")  # Log the type
+    # Get the sports the user is currently searching for
+    sports_selected = searching_sports(user)
+    logger.debug("sportsSelected for user %s: %r", user_telegram_id, sports_selected)
 
-    if not sports_selected_str:
-        print(f"[DEBUG] sportsSelected is empty for user {user_telegram_id}")  # Debug log
+    if not sports_selected:
         await update.message.reply_text("You are not currently searching for any sports.")
         return
     
-    # Create inline keyboard with the single sport option
-    # (assuming sportsSelected contains just one sport as a string)
-    keyboard = [
-        [InlineKeyboardButton(sports_selected_str, callback_data=f"endsearch_{sports_selected_str}")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    # Inline keyboard with a button for each sport being searched for
     await update.message.reply_text(
-        "You are currently searching for matches! Click the button below to stop searching:",
-        reply_markup=reply_markup
+        templates.END_SEARCH,
+        reply_markup=templates.end_search_keyboard(tuple(sports_selected))
     )
 
 # Callback handler for end search selection
-async def end_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def end_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()
     
     user_telegram_id = query.from_user.id
-    data = query.data
+    sport = data.sport
     
-    sport = data.split("_")[1]
-    
-    # Update MongoDB - set wantToBeMatched to false
-    users_collection.update_one(
+    # Remove the sport from the user's search
+    user = await users_collection.find_one_and_update(
         {"telegramId": user_telegram_id},
-        {"$set": {"wantToBeMatched": False, "smartMatch": False}}
+        {"$pull": {"sportSearches": {"sport": sport}}},
+        return_document=ReturnDocument.AFTER
     )
+    matching_engine.remove(user_telegram_id, sport)
+    
+    # Update MongoDB - set wantToBeMatched to false once no sports are left
+    if user is not None and not user.get("sportSearches"):
+        await users_collection.update_one(
+            {"telegramId": user_telegram_id, "$or": [{"sportSearches": {"$size": 0}}, {"sportSearches": {"$exists": False}}]},
+            {"$set": {"wantToBeMatched": False, "smartMatch": False}}
+        )
+        matching_engine.remove(user_telegram_id)
     
     await query.edit_message_text(f"OK, you have ended the search for {sport}.")
 
 # /endmatch function
 async def end_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
 
     if not user:
         await update.message.reply_text("Please complete your profile first!")
@@ -499,123 +1093,138 @@ async def end_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Find the match document for the user
-    match_document = matches_collection.find_one({
+    match_document = await matches_collection.find_one({
         "$or": [
             {"userAId": user_telegram_id},
             {"userBId": user_telegram_id}
         ],
         "status": "active"
-    })
+    }, MATCH_PARTICIPANT_FIELDS)
 
     if not match_document:
         await update.message.reply_text("No active match found!")
         return
 
     # Update match status to "ended"
-    matches_collection.update_one(
+    await matches_collection.update_one(
         {"_id": match_document["_id"]},
         {"$set": {"status": "ended"}}
     )
 
     # Update users' isMatched status and wantToBeMatched status
-    users_collection.update_many(
+    await users_collection.update_many(
         {"telegramId": {"$in": [user_telegram_id, match_document["userAId"], match_document["userBId"]]}},
-        {"$set": {"isMatched": False, "wantToBeMatched": False, "smartMatch": False}}  # Reset both flags
+        {"$set": {"isMatched": False, "wantToBeMatched": False, "smartMatch": False, "sportSearches": []}}  # Reset both flags
     )
+    matching_engine.remove(match_document["userAId"])
+    matching_engine.remove(match_document["userBId"])
+    forget_match(match_document["userAId"], match_document["userBId"])
 
     # Send the match end message to both users
     await update.message.reply_text("Your match has ended.")
     
     other_user_id = match_document["userAId"] if match_document["userBId"] == user_telegram_id else match_document["userBId"]
-    other_user = users_collection.find_one({"telegramId": other_user_id})
+    other_user = await users_collection.find_user_fields(other_user_id, DISPLAY_NAME_FIELDS)
     
     if other_user:
-        await context.bot.send_message(
+        outbound.send_message(
             chat_id=other_user["telegramId"],
             text="The other sports-finder has ended the match."
         )
 
-    # Ask both users for feedback
-    feedback_keyboard = [
-        [InlineKeyboardButton("Yes", callback_data=f"feedback_yes_{match_document['_id']}")],
-        [InlineKeyboardButton("No", callback_data=f"feedback_no_{match_document['_id']}")]
-    ]
-    feedback_markup = InlineKeyboardMarkup(feedback_keyboard)
-
-    await context.bot.send_message(
-        chat_id=user_telegram_id,
-        text="Was a game played?",
-        reply_markup=feedback_markup
-    )
-    await context.bot.send_message(
-        chat_id=other_user_id,
-        text="Was a game played?",
-        reply_markup=feedback_markup
-    )
+    # Ask both users for feedback; each user's buttons carry their side of the match
+    for role, partner_role in [("A", "B"), ("B", "A")]:
+        outbound.send_message(
+            chat_id=match_document[f"user{role}Id"],
+            text=templates.GAME_PLAYED_QUESTION,
+            reply_markup=templates.GAME_PLAYED_KEYBOARD.render(
+                match_document["_id"], role, match_document[f"user{partner_role}Id"]
+            )
+        )
 
 # Function to forward messages between matched users
 async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    active_partner = active_partners.get(user_telegram_id)
 
-    if not user or not user.get("isMatched", False):
-        return  # The user is not matched or doesn't exist
-    
-    # Find the match document for the user
-    match_document = matches_collection.find_one({
-        "$or": [
-            {"userAId": user_telegram_id},
-            {"userBId": user_telegram_id}
-        ],
-        "status": "active"
-    })
+    if not active_partner:
+        # Not cached yet (e.g. after a restart), look the match up in MongoDB once
+        user = await users_collection.find_user(user_telegram_id)
 
-    if not match_document:
-        return  # No active match found
+        if not user or not user.get("isMatched", False):
+            return  # The user is not matched or doesn't exist
+        
+        # Find the match document for the user
+        match_document = await matches_collection.find_one({
+            "$or": [
+                {"userAId": user_telegram_id},
+                {"userBId": user_telegram_id}
+            ],
+            "status": "active"
+        }, MATCH_PARTICIPANT_FIELDS)
 
-    # Determine the other user in the match
-    other_user_id = match_document["userAId"] if match_document["userBId"] == user_telegram_id else match_document["userBId"]
+        if not match_document:
+            return  # No active match found
+
+        # Determine the other user in the match
+        other_user_id = match_document["userAId"] if match_document["userBId"] == user_telegram_id else match_document["userBId"]
+        active_partner = ActivePartner(other_user_id, user.get("displayName", "Unknown"), match_document["_id"])
+        active_partners[user_telegram_id] = active_partner
 
     # Forward the message to the other user
-    await context.bot.send_message(
-        chat_id=other_user_id,
-        text=f"Message from {user.get('displayName', 'Unknown')}: {update.message.text}"
+    outbound.send_message(
+        chat_id=active_partner.partner_id,
+        text=f"Message from {active_partner.display_name}: {update.message.text}"
+    )
+
+# The clicking user's side of a match ("A" or "B") and their partner's telegramId.
+# New buttons carry both; for buttons sent before that the match is looked up.
+# Returns None after telling the user when the match isn't theirs.
+async def match_role(query, data):
+    if data.role is not None:
+        return data.role, data.partner_id
+
+    user_telegram_id = query.from_user.id
+    match_document = await matches_collection.find_one({"_id": data.match_id}, MATCH_PARTICIPANT_FIELDS)
+
+    if not match_document:
+        await query.edit_message_text("Match not found.")
+        return None
+
+    if user_telegram_id == match_document["userAId"]:
+        return "A", match_document["userBId"]
+    if user_telegram_id == match_document["userBId"]:
+        return "B", match_document["userAId"]
+    await query.edit_message_text("You are not part of this match.")
+    return None
+
+# Record a feedback answer on the user's side of the match (written in the background).
+# The filter also checks the user really is that side of the match.
+def save_match_feedback(match_id, role, user_telegram_id, field, value):
+    write_buffer.set_fields(
+        matches_collection,
+        {"_id": match_id, f"user{role}Id": user_telegram_id},
+        {f"{field}{role}": value}
     )
 
 # Callback function when feedback is provided
-async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the feedback and match ID from the callback data
-        feedback, match_id = query.data.split("_")[1], query.data.split("_")[2]
+        feedback = "yes" if data.value else "no"
         user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
+        match_id = data.match_id
 
         # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "gamePlayedA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "gamePlayedB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
-            return 
+        match = await match_role(query, data)
+        if not match:
+            return
+        role, partner_id = match
 
         # Update the match document with the feedback
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: feedback}}
-        )
+        save_match_feedback(match_id, role, user_telegram_id, "gamePlayed", feedback)
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"Was the game played? You responded: {feedback}.")
@@ -623,148 +1232,89 @@ async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Ask follow-up questions based on the response
         if feedback == "yes":
             # Ask about the experience with the bot
-            bot_experience_keyboard = [
-                [InlineKeyboardButton("⭐ 1", callback_data=f"bot_experience_1_{match_id}")],
-                [InlineKeyboardButton("⭐ 2", callback_data=f"bot_experience_2_{match_id}")],
-                [InlineKeyboardButton("⭐ 3", callback_data=f"bot_experience_3_{match_id}")],
-                [InlineKeyboardButton("⭐ 4", callback_data=f"bot_experience_4_{match_id}")],
-                [InlineKeyboardButton("⭐ 5", callback_data=f"bot_experience_5_{match_id}")]
-            ]
-            bot_experience_markup = InlineKeyboardMarkup(bot_experience_keyboard)
-            await context.bot.send_message(
+            outbound.send_message(
                 chat_id=user_telegram_id,
-                text="How was your experience using SportsFinder’s bot?",
-                reply_markup=bot_experience_markup
+                text=templates.BOT_EXPERIENCE_QUESTION,
+                reply_markup=templates.BOT_EXPERIENCE_KEYBOARD.render(match_id, role, partner_id)
             )
         else:
             # Ask why the game wasn't played
-            no_game_reasons_keyboard = [
-                [InlineKeyboardButton("Couldn’t find a common date", callback_data=f"no_game_reason_1_{match_id}")],
-                [InlineKeyboardButton("Match was unresponsive/unwilling to play", callback_data=f"no_game_reason_2_{match_id}")],
-                [InlineKeyboardButton("Uncomfortable with other player", callback_data=f"no_game_reason_3_{match_id}")],
-                [InlineKeyboardButton("Decided not to play", callback_data=f"no_game_reason_4_{match_id}")],
-                [InlineKeyboardButton("Others", callback_data=f"no_game_reason_5_{match_id}")]
-            ]
-            no_game_reasons_markup = InlineKeyboardMarkup(no_game_reasons_keyboard)
-            await context.bot.send_message(
+            outbound.send_message(
                 chat_id=user_telegram_id,
-                text="Sorry to hear that! Why wasn’t a game played?",
-                reply_markup=no_game_reasons_markup
+                text=templates.NO_GAME_REASON_QUESTION,
+                reply_markup=templates.NO_GAME_REASON_KEYBOARD.render(match_id, role, partner_id)
             )
 
     except Exception as e:
         # Log the error and notify the user
-        print(f"Error in feedback_response: {e}")
+        logger.exception("Error in feedback_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for bot experience rating
-async def bot_experience_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def bot_experience_response(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the rating and match ID from the callback data
-        rating, match_id = query.data.split("_")[2], query.data.split("_")[3]
+        rating = str(data.value)
         user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
+        match_id = data.match_id
 
         # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "botExperienceA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "botExperienceB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
+        match = await match_role(query, data)
+        if not match:
             return
+        role, partner_id = match
 
         # Update the match document with the bot experience rating
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: rating}}
-        )
+        save_match_feedback(match_id, role, user_telegram_id, "botExperience", rating)
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"How was your experience using SportsFinder’s bot? You responded: ⭐ {rating}.")
 
         # Ask about the experience with the matched user
-        other_user_id = match_document["userBId"] if user_telegram_id == match_document["userAId"] else match_document["userAId"]
-        other_user = users_collection.find_one({"telegramId": other_user_id})
-        other_user_display_name = other_user.get("displayName", "Unknown")
-
-        user_experience_keyboard = [
-            [InlineKeyboardButton("⭐ 1", callback_data=f"user_experience_1_{match_id}")],
-            [InlineKeyboardButton("⭐ 2", callback_data=f"user_experience_2_{match_id}")],
-            [InlineKeyboardButton("⭐ 3", callback_data=f"user_experience_3_{match_id}")],
-            [InlineKeyboardButton("⭐ 4", callback_data=f"user_experience_4_{match_id}")],
-            [InlineKeyboardButton("⭐ 5", callback_data=f"user_experience_5_{match_id}")]
-        ]
-        user_experience_markup = InlineKeyboardMarkup(user_experience_keyboard)
-        await context.bot.send_message(
+        other_user = await users_collection.find_user_fields(partner_id, DISPLAY_NAME_FIELDS)
+        other_user_display_name = other_user.get("displayName", "Unknown") if other_user else "Unknown"
+
+        outbound.send_message(
             chat_id=user_telegram_id,
-            text=f"How was your experience with {other_user_display_name}?",
-            reply_markup=user_experience_markup
+            text=templates.USER_EXPERIENCE_QUESTION.format(display_name=other_user_display_name),
+            reply_markup=templates.USER_EXPERIENCE_KEYBOARD.render(match_id, role, partner_id)
         )
 
     except Exception as e:
         # Log the error and notify the user
-        print(f"Error in bot_experience_response: {e}")
+        logger.exception("Error in bot_experience_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for user experience rating
-async def user_experience_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_experience_response(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the rating and match ID from the callback data
-        rating, match_id = query.data.split("_")[2], query.data.split("_")[3]
+        rating = str(data.value)
         user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
+        match_id = data.match_id
 
         # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "userExperienceA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "userExperienceB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
+        match = await match_role(query, data)
+        if not match:
             return
-    
+        role, partner_id = match
 
         # Update the match document with the user experience rating
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: rating}}
-        )
+        save_match_feedback(match_id, role, user_telegram_id, "userExperience", rating)
 
         # the other user
-        other_user_id = match_document["userBId"] if user_telegram_id == match_document["userAId"] else match_document["userAId"]
-        other_user = users_collection.find_one({"telegramId": other_user_id})
-        other_user_display_name = other_user.get("displayName", "Unknown")
+        other_user = await users_collection.find_user_fields(partner_id, DISPLAY_NAME_FIELDS)
+        other_user_display_name = other_user.get("displayName", "Unknown") if other_user else "Unknown"
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"How was your experience with {other_user_display_name}? You responded: ⭐ {rating}.")
 
         # Send a final thank you message
-        await context.bot.send_message(
+        outbound.send_message(
             chat_id=user_telegram_id,
             text="Thank you for your feedback!"
         )
@@ -772,69 +1322,42 @@ async def user_experience_response(update: Update, context: ContextTypes.DEFAULT
 
     except Exception as e:
         # Log the error and notify the user
-        print(f"Error in user_experience_response: {e}")
+        logger.exception("Error in user_experience_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for no game reasons
-async def no_game_reason_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def no_game_reason_response(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the reason and match ID from the callback data
-        callback_data = query.data
-        parts = callback_data.split("_", 4)  # Split into 5 parts only
-        
-        if len(parts) != 5:
-            await query.edit_message_text("Invalid callback data format.")
-            return
-
-        reason, match_id = parts[3], parts[4]
+        reason = str(data.value)
         user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        try:
-            match_id = ObjectId(match_id)
-        except Exception as e:
-            await query.edit_message_text("Invalid match ID.")
-            return
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
+        match_id = data.match_id
 
         # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "noGameReasonA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "noGameReasonB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
+        match = await match_role(query, data)
+        if not match:
             return
-        
+        role, partner_id = match
+
         reason_text = NO_GAME_REASONS.get(reason, "Unknown reason")
 
         # Update the match document with the reason
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: reason}}
-        )
+        save_match_feedback(match_id, role, user_telegram_id, "noGameReason", reason)
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"Why wasn’t a game played? You responded: {reason_text}.")
 
         # Send a final thank you message
-        await context.bot.send_message(
+        outbound.send_message(
             chat_id=user_telegram_id,
             text="Thank you for your feedback!"
         )
 
     except Exception as e:
         # Log the error and notify the user
-        print(f"Error in no_game_reason_response: {e}")
+        logger.exception("Error in no_game_reason_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 
@@ -845,30 +1368,66 @@ def is_profile_complete(user):
     required_fields = ["age", "gender", "sports"]
     return all(user.get(field) for field in required_fields)
 
+def parse_age(user):
+    """Return the user's age as an int (ages may be stored as strings)."""
+    try:
+        return int(user.get("age", 0))
+    except (TypeError, ValueError):
+        return 0
+
+def get_sport_preferences(user, sport):
+    """Return the user's parsed match preferences for one sport."""
+    match_preferences = preference_cache.get(user) or {}
+    return match_preferences.get(sport, NO_PREFERENCES)
+
+def searching_sports(user):
+    """Return the sports a user is searching for."""
+    return [search["sport"] for search in user.get("sportSearches") or []]
+
+def sport_search(user, sport):
+    """Return the user's search for a sport (smartMatch, smartMatchStage and matchStartTime)."""
+    for search in user.get("sportSearches") or []:
+        if search["sport"] == sport:
+            return search
+    return {}
+
+def waiting_entry(user, sport):
+    """Build the matching engine entry for a user searching in a sport."""
+    search = sport_search(user, sport)
+    return WaitingUser(
+        telegram_id=user["telegramId"],
+        sport=sport,
+        age=parse_age(user),
+        gender=user.get("gender"),
+        skill_level=user.get("sports", {}).get(sport, "Unknown"),
+        smart_match=search.get("smartMatch", False),
+        start_time=search.get("matchStartTime"),
+        display_name=user.get("displayName", "Unknown"),
+        username=user.get("username", "Unknown"),
+        preferences=get_sport_preferences(user, sport),
+        stage=search.get("smartMatchStage", 0),
+    )
+
 async def are_preferences_complete(update: Update, user):
     """Check if the user's match preferences include all their sports."""
     
     # Extract user's sports and matchPreferences (ensuring matchPreferences is always a dictionary)
     sports = user.get("sports", [])  # Ensure we have a list of sports
-    print("all sports user selected: ", sports, type(sports))
+    logger.debug("all sports user selected: %s", sports)
     
-    # Retrieve the current user's match preferences for the selected sport
-    match_preferences = user.get("matchPreferences", {})
+    # Retrieve the current user's parsed match preferences (cached per user)
+    match_preferences = preference_cache.get(user)
 
-    # Convert from string to dictionary 
-    if isinstance(match_preferences, str):
-        try:
-            match_preferences = json.loads(match_preferences)  # Convert JSON string to dictionary
-        except json.JSONDecodeError:
-            print("Error: matchPreference is not a valid JSON format.")
-            await update.message.reply_text("Your match preferences are not in a valid format. Please update them.")
-            return False  # Return False if the JSON is invalid
+    if match_preferences is None:
+        logger.warning("matchPreferences of user %s is not valid JSON", user.get("telegramId"))
+        await update.message.reply_text("Your match preferences are not in a valid format. Please update them.")
+        return False  # Return False if the JSON is invalid
 
-    print("match preferences of the user", match_preferences, type(match_preferences))
+    logger.debug("match preferences of the user for sports: %s", list(match_preferences))
 
     # Find sports that are missing from matchPreferences
     missing_sports = [sport for sport in sports if sport not in match_preferences]
-    print("missing sports: ", missing_sports)
+    logger.debug("missing sports: %s", missing_sports)
 
     # If there are missing sports, inform the user to complete their preferences
     if missing_sports:
@@ -888,7 +1447,7 @@ FEEDBACK = 1
 # Command handler for /feedback
 async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = int(update.message.from_user.id)  # Ensure it's an integer
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_user(user_telegram_id)
 
     # Check if the user is in a match
     if user.get("isMatched", False):
@@ -897,7 +1456,7 @@ async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return  # Do not start the feedback conversation
     
-    print("/feedback command triggered")  # Debugging print
+    logger.debug("/feedback command triggered")
     await update.message.reply_text("Provide any feedback/ reports here! Every response is greatly appreciated and every single one of them will be read! Type below:")
     context.user_data["feedback_state"] = FEEDBACK  # Debugging: Track state in user_data
     return FEEDBACK  # Move to the FEEDBACK state
@@ -907,13 +1466,12 @@ async def receive_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_username = update.message.from_user.username or "Unknown"
 
     """Receive the user's feedback and acknowledge it."""
-    print("User sent feedback")  # Debugging print
-    print(f"Current state: {context.user_data.get('feedback_state')}")  # Debugging print
+    logger.debug("User sent feedback, current state: %s", context.user_data.get("feedback_state"))
     user_feedback = update.message.text  # Get the user's message
     user_telegram_id = update.message.from_user.id
 
-    # Save the feedback to MongoDB
-    feedback_collection.insert_one({
+    # Save the feedback to MongoDB (written in the background)
+    write_buffer.insert(feedback_collection, {
         "telegramId": user_telegram_id,
         "username": user_username,
         "feedback": user_feedback,
@@ -927,65 +1485,234 @@ async def receive_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Fallback handler to cancel the conversation
 async def cancel_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the feedback conversation."""
-    print("Feedback process cancelled")  # Debugging print
+    logger.debug("Feedback process cancelled")
     await update.message.reply_text("Feedback process cancelled.")
     return ConversationHandler.END
 
-# Define the setup_handlers function
-def setup_handlers(application):
+# Button handlers by callback action; they get the decoded callback data as a third argument
+CALLBACK_HANDLERS = {
+    callbacks.SPORT: sport_selected,
+    callbacks.SMART_MATCH: smart_match_response,
+    callbacks.END_SEARCH: end_search_callback,
+    callbacks.GAME_PLAYED: feedback_response,
+    callbacks.BOT_EXPERIENCE: bot_experience_response,
+    callbacks.USER_EXPERIENCE: user_experience_response,
+    callbacks.NO_GAME_REASON: no_game_reason_response,
+}
+
+# Register every handler of the bot (timed per handler when metrics are enabled)
+def register_handlers(application):
+    instrumented = metrics_registry.instrumented
+
     # Feedback conversation handler
     feedback_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("feedback", feedback_command)],  # Start with /feedback
+        entry_points=[CommandHandler("feedback", instrumented(feedback_command))],  # Start with /feedback
         states={
-            FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_feedback)],  # Wait for user input
+            FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(receive_feedback))],  # Wait for user input
         },
-        fallbacks=[CommandHandler("cancel", cancel_feedback)],
+        fallbacks=[CommandHandler("cancel", instrumented(cancel_feedback))],
+        name="feedback",
+        persistent=True,  # Survives restarts (see MongoPersistence)
     )
 
     # Add the feedback conversation handler to the application
     application.add_handler(feedback_conv_handler)
-    # Add the Smart-Match callback handler
-    application.add_handler(CallbackQueryHandler(smart_match_response, pattern="^smartmatch_"))
-
-# Call the setup_handlers function to add the feedback conversation handler
-setup_handlers(application)
-
-# Register the /start, /matchme, /endmatch command handlers and the message handler for forwarding messages
-start_handler = CommandHandler('start', start)
-application.add_handler(start_handler)
-
-editprofile_handler = CommandHandler('profile', edit_profile)
-application.add_handler(editprofile_handler)
-
-matchpreferences_handler = CommandHandler('matchpreferences', match_preferences)
-application.add_handler(matchpreferences_handler)
 
-matchme_handler = CommandHandler('matchme', match_me)
-application.add_handler(matchme_handler)
-
-endmatch_handler = CommandHandler('endmatch', end_match)
-application.add_handler(endmatch_handler)
-
-message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, forward_message)
-application.add_handler(message_handler)
-
-# Register the callback query handler for sport selection
-application.add_handler(CallbackQueryHandler(sport_selected, pattern="^sport_"))
-
-# Register the callback query handler for feedback responses
-application.add_handler(CallbackQueryHandler(feedback_response, pattern="^feedback_"))
-
-# Register the callback query handlers for follow-up questions
-application.add_handler(CallbackQueryHandler(bot_experience_response, pattern="^bot_experience_"))
-application.add_handler(CallbackQueryHandler(user_experience_response, pattern="^user_experience_"))
-application.add_handler(CallbackQueryHandler(no_game_reason_response, pattern="^no_game_reason_"))
+    # Register the /start, /matchme, /endmatch command handlers and the message handler for forwarding messages
+    application.add_handler(CommandHandler('start', instrumented(start)))
+    application.add_handler(CommandHandler('profile', instrumented(edit_profile)))
+    application.add_handler(CommandHandler('matchpreferences', instrumented(match_preferences)))
+    application.add_handler(CommandHandler('matchme', instrumented(match_me)))
+    application.add_handler(CommandHandler('endmatch', instrumented(end_match)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(forward_message)))
+
+    #/endsearch
+    application.add_handler(CommandHandler('endsearch', instrumented(end_search)))
+
+    # Every button press: sport selection, Smart-Match, end search, feedback and the follow-up questions
+    callback_handlers = {action: instrumented(handler) for action, handler in CALLBACK_HANDLERS.items()}
+
+    async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = callbacks.decode(update.callback_query.data)
+        handler = callback_handlers.get(data.action) if data else None
+        if handler is None:
+            await update.callback_query.answer("This button is no longer valid.")
+            return
+        await handler(update, context, data)
+
+    application.add_handler(CallbackQueryHandler(dispatch_callback))
+
+# Set up the module's services (database, caches, outbound queue, metrics) from config.
+# Nothing connects until it is first used.
+def configure(new_config):
+    global config, db_executor, mongo_profiler, outbound, write_buffer
+    config = new_config
+    metrics_registry.enabled = config.metrics_port > 0
+    db_executor = ThreadPoolExecutor(max_workers=config.db_thread_pool_size, thread_name_prefix="mongo")
+    if config.mongo_profile:
+        from profiler import MongoProfiler
+        mongo_profiler = MongoProfiler(executor=db_executor)
+    matching_engine.ranking = config.match_ranking
+    user_cache.max_size = config.user_cache_size
+    user_cache.ttl = config.user_cache_ttl
+    outbound = OutboundDispatcher(
+        workers=config.outbound_workers,
+        global_rate=config.outbound_global_rate,
+        per_chat_rate=config.outbound_per_chat_rate,
+        observe_latency=metrics_registry.telegram_seconds.observe if metrics_registry.enabled else None
+    )
+    write_buffer = WriteBehindBuffer(
+        flush_interval=config.write_buffer_interval,
+        max_pending=config.write_buffer_max_pending,
+    )
 
-#/endsearch
-application.add_handler(CommandHandler('endsearch', end_search))
-application.add_handler(CallbackQueryHandler(end_search_callback, pattern="^endsearch_"))
+# Create the Telegram Bot application
+def create_app(config):
+    global application
+    configure(config)
+    application = (
+        Application.builder()
+        # PTB's own limit is taken before the per-user lock, so UserOrderedApplication enforces it instead
+        .application_class(UserOrderedApplication, {"max_concurrent_updates": config.concurrent_updates})
+        .concurrent_updates(sys.maxsize)
+        .token(config.token)
+        .persistence(MongoPersistence(bot_state_collection, update_interval=config.persistence_update_interval))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    return application
+
+# Log the time from importing bot.py to a ready application, warning when it's over budget
+def check_startup_budget():
+    startup_ms = (time.perf_counter() - IMPORT_STARTED) * 1000
+    if startup_ms > config.startup_budget_ms:
+        logger.warning("Startup took %.0f ms, over the %d ms budget", startup_ms, config.startup_budget_ms)
+    else:
+        logger.info("Startup took %.0f ms", startup_ms)
+
+# One-off migration that rewrites JSON string matchPreferences into native documents
+def migrate_match_preferences(batch_size=500):
+    collection = users_collection.collection
+    requests = []
+    migrated = 0
+    for user in collection.find({"matchPreferences": {"$type": "string"}}, {"matchPreferences": 1}):
+        try:
+            match_preferences = json.loads(user["matchPreferences"])
+        except json.JSONDecodeError:
+            logger.warning("Skipping user %s: matchPreferences is not valid JSON", user["_id"])
+            continue
+        requests.append(UpdateOne({"_id": user["_id"]}, {"$set": {"matchPreferences": match_preferences}}))
+        if len(requests) >= batch_size:
+            migrated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        migrated += collection.bulk_write(requests, ordered=False).modified_count
+    logger.info("Migrated matchPreferences for %d users", migrated)
+
+# Webhook worker process: processes the updates routed to it by the webhook server
+def run_webhook_worker(config, worker_index, update_queue):
+    configure_logging(config)
+    application = create_app(config)
+    check_startup_budget()
+    asyncio.run(process_webhook_updates(application, worker_index, update_queue))
+
+async def process_webhook_updates(application, worker_index, update_queue):
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    application.bot_data["worker_index"] = worker_index
+    await on_startup(application)
+    await application.start()
+    try:
+        while True:
+            update_data = await loop.run_in_executor(None, update_queue.get)
+            if update_data is None:
+                break  # The webhook server is shutting down
+            if "invalidate_user" in update_data:
+                invalidate_user(update_data["invalidate_user"])
+                continue
+            await application.update_queue.put(Update.de_json(update_data, application.bot))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+
+# Webhook server: receives updates from Telegram and routes each one to a worker
+# process chosen by user, so every user's updates are handled by the same worker
+# (and therefore in order), while different users are spread across all cores
+def run_webhook_server(config):
+    import multiprocessing
+
+    # The server accepts updates from anyone who can reach it, the secret is what tells Telegram apart
+    if not config.webhook_secret:
+        raise SystemExit("WEBHOOK_SECRET must be set to run in webhook mode")
+
+    process_context = multiprocessing.get_context("spawn")
+    update_queues = [process_context.Queue() for _ in range(config.webhook_workers)]
+    workers = [
+        process_context.Process(target=run_webhook_worker, args=(config, index, update_queue), daemon=True)
+        for index, update_queue in enumerate(update_queues)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(serve_webhook(config, update_queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for update_queue in update_queues:
+            update_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+async def serve_webhook(config, update_queues):
+    async def receive_update(headers, body):
+        if headers.get("x-telegram-bot-api-secret-token") != config.webhook_secret:
+            return 403, "Forbidden"
+        update_data = json.loads(body)
+        update_queues[routing_key(update_data) % len(update_queues)].put(update_data)
+        return 200, "OK"
+
+    # Called by the web apps after they edit a profile: {"telegramId": <id>}
+    async def receive_user_invalidation(headers, body):
+        if not config.webhook_secret or headers.get("authorization") != f"Bearer {config.webhook_secret}":
+            return 403, "Forbidden"
+        telegram_id = int(json.loads(body)["telegramId"])
+        # Any worker may have the user cached (e.g. as someone's match)
+        for update_queue in update_queues:
+            update_queue.put({"invalidate_user": telegram_id})
+        return 200, "OK"
+
+    async with Bot(config.token) as bot:
+        await bot.set_webhook(
+            url=f"{config.webhook_url.rstrip('/')}/telegram",
+            secret_token=config.webhook_secret,
+            allowed_updates=Update.ALL_TYPES
+        )
+    logger.info("Webhook server listening on port %d with %d workers", config.port, len(update_queues))
+    await serve_http(
+        {
+            ("POST", "/telegram"): receive_update,
+            ("POST", "/users/invalidate"): receive_user_invalidation,
+        },
+        "0.0.0.0",
+        config.port
+    )
 
-# smart match
-application.add_handler(CallbackQueryHandler(smart_match_response, pattern="^smartmatch_"))
+def main():
+    config = Config.from_env()
+    configure_logging(config)
+    if "--migrate-preferences" in sys.argv:
+        configure(config)
+        migrate_match_preferences()
+    elif config.webhook_url:
+        run_webhook_server(config)
+    else:
+        # Start the bot
+        application = create_app(config)
+        check_startup_budget()
+        application.run_polling()
 
-# Start the bot
-application.run_polling()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,123 @@
+import base64
+import binascii
+import struct
+from collections import namedtuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+# Telegram's limit on callback_data, in bytes
+MAX_CALLBACK_DATA = 64
+
+# Marks encoded callback data; the old underscore strings never start with it
+PREFIX = "~"
+
+# Actions
+SPORT = 1  # sport
+SMART_MATCH = 2  # value (1 = on, 0 = off), sport
+END_SEARCH = 3  # sport
+GAME_PLAYED = 4  # match, role, partner, value (1 = yes, 0 = no)
+BOT_EXPERIENCE = 5  # match, role, partner, value (rating)
+USER_EXPERIENCE = 6  # match, role, partner, value (rating)
+NO_GAME_REASON = 7  # match, role, partner, value (NO_GAME_REASONS key)
+
+# Flags telling which fields follow the action and flags bytes
+HAS_MATCH = 1  # 12 byte ObjectId
+HAS_ROLE = 2
+ROLE_B = 4
+HAS_PARTNER = 8  # 8 byte Telegram id
+HAS_VALUE = 16  # 1 byte
+HAS_SPORT = 32  # 1 byte length + UTF-8
+
+CallbackData = namedtuple(
+    "CallbackData",
+    ["action", "match_id", "role", "partner_id", "value", "sport"],
+    defaults=(None, None, None, None, None),
+)
+
+
+def encode(action, match_id=None, role=None, partner_id=None, value=None, sport=None):
+    """Pack callback fields into base64 callback_data of at most 64 bytes.
+
+    role is the clicking user's side of the match ("A" or "B") and
+    partner_id the other side's telegramId, so handlers need no lookup.
+    """
+    flags = 0
+    fields = b""
+    if match_id is not None:
+        flags |= HAS_MATCH
+        fields += ObjectId(match_id).binary
+    if role is not None:
+        flags |= HAS_ROLE | (ROLE_B if role == "B" else 0)
+    if partner_id is not None:
+        flags |= HAS_PARTNER
+        fields += struct.pack(">q", partner_id)
+    if value is not None:
+        flags |= HAS_VALUE
+        fields += struct.pack(">B", value)
+    if sport is not None:
+        sport_bytes = sport.encode("utf-8")
+        flags |= HAS_SPORT
+        fields += struct.pack(">B", len(sport_bytes)) + sport_bytes
+    data = PREFIX + base64.urlsafe_b64encode(bytes([action, flags]) + fields).rstrip(b"=").decode("ascii")
+    if len(data) > MAX_CALLBACK_DATA:
+        raise ValueError(f"Callback data is {len(data)} bytes, over Telegram's {MAX_CALLBACK_DATA} byte limit")
+    return data
+
+
+def decode(data):
+    """Return the CallbackData of encoded or old-style callback data, or None if it can't be parsed."""
+    if not data.startswith(PREFIX):
+        return decode_legacy(data)
+    try:
+        raw = base64.urlsafe_b64decode(data[len(PREFIX):] + "=" * (-len(data[len(PREFIX):]) % 4))
+        action, flags = raw[0], raw[1]
+        offset = 2
+        match_id = role = partner_id = value = sport = None
+        if flags & HAS_MATCH:
+            match_id = ObjectId(raw[offset:offset + 12])
+            offset += 12
+        if flags & HAS_ROLE:
+            role = "B" if flags & ROLE_B else "A"
+        if flags & HAS_PARTNER:
+            (partner_id,) = struct.unpack_from(">q", raw, offset)
+            offset += 8
+        if flags & HAS_VALUE:
+            value = raw[offset]
+            offset += 1
+        if flags & HAS_SPORT:
+            length = raw[offset]
+            sport = raw[offset + 1:offset + 1 + length].decode("utf-8")
+    except (binascii.Error, IndexError, TypeError, struct.error, InvalidId, UnicodeDecodeError):
+        return None
+    return CallbackData(action, match_id, role, partner_id, value, sport)
+
+
+# Old-style prefixes, still found on buttons sent before the encoding changed
+LEGACY_MATCH_ACTIONS = [
+    ("bot_experience_", BOT_EXPERIENCE),
+    ("user_experience_", USER_EXPERIENCE),
+    ("no_game_reason_", NO_GAME_REASON),
+]
+
+
+def decode_legacy(data):
+    try:
+        if data.startswith("sport_"):
+            return CallbackData(SPORT, sport=data[len("sport_"):])
+        if data.startswith("smartmatch_"):
+            setting, sport = data[len("smartmatch_"):].split("_", 1)
+            return CallbackData(SMART_MATCH, value=int(setting == "on"), sport=sport)
+        if data.startswith("endsearch_"):
+            return CallbackData(END_SEARCH, sport=data[len("endsearch_"):])
+        if data.startswith("feedback_"):
+            feedback, match_id = data[len("feedback_"):].split("_", 1)
+            return CallbackData(GAME_PLAYED, ObjectId(match_id), value=int(feedback == "yes"))
+        for prefix, action in LEGACY_MATCH_ACTIONS:
+            if data.startswith(prefix):
+                value, match_id = data[len(prefix):].split("_", 1)
+                return CallbackData(action, ObjectId(match_id), value=int(value))
+    except (ValueError, InvalidId):
+        pass
+    return None
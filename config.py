@@ -0,0 +1,106 @@
+import os
+
+
+class Config:
+    """Settings of the bot.
+
+    The class attributes are the defaults; Config(**settings) overrides some
+    of them (e.g. in the benchmark) and Config.from_env() reads every setting
+    from the environment and the .env file.
+    """
+
+    token = None
+    database_url = None  # MongoDB connection string
+    database_name = "test_database"
+    log_level = "INFO"
+
+    # Webhook mode is used when webhook_url (the public https URL of this app) is set,
+    # otherwise the bot long-polls
+    webhook_url = None
+    webhook_secret = ""  # Checked against Telegram's secret token header, required in webhook mode
+    webhook_workers = os.cpu_count() or 1  # Update processing processes
+    port = 8443
+
+    # MongoDB connection pool and timeouts
+    mongo_max_pool_size = 50
+    mongo_timeout_ms = 5000
+    db_thread_pool_size = None  # Threads running blocking pymongo calls, defaults to mongo_max_pool_size
+    mongo_profile = False  # Log every update's MongoDB operations (runs explain(), not for production)
+
+    metrics_port = 0  # Prometheus metrics are served on this port when set
+    metrics_host = "127.0.0.1"  # Only reachable locally unless set to e.g. 0.0.0.0
+
+    user_cache_size = 5000
+    user_cache_ttl = 60.0  # seconds before a profile is re-read from MongoDB
+
+    outbound_workers = 8
+    outbound_global_rate = 30.0  # messages per second for the whole bot
+    outbound_per_chat_rate = 1.0  # messages per second per chat
+
+    concurrent_updates = 64  # Maximum number of updates processed at the same time
+    persistence_update_interval = 60  # seconds between writes of conversation states and user_data
+    write_buffer_interval = 1.0  # seconds feedback writes may wait before they are written
+    write_buffer_max_pending = 500  # buffered feedback writes that trigger an early write
+
+    match_ranking = False  # Offer the best scored candidates first instead of the longest waiting
+    match_candidates = 10  # Candidates a search tries to claim before waiting for the next sweep
+
+    smart_match_poll_interval = 15  # seconds between due Smart-Match checks
+    smart_match_batch_size = 100  # due users processed per check
+    matching_sweep_interval = 30  # seconds between matching sweeps
+    user_sync_poll_interval = 30  # seconds, only used without change streams
+
+    startup_budget_ms = 1500  # A slower start (import to application built) is logged as a warning
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(Config, name):
+                raise TypeError(f"Unknown setting: {name}")
+            setattr(self, name, value)
+        if self.db_thread_pool_size is None:
+            self.db_thread_pool_size = self.mongo_max_pool_size
+
+    @classmethod
+    def from_env(cls):
+        # Load environment variables from .env file
+        from dotenv import load_dotenv
+        load_dotenv()
+
+        settings = {
+            "token": os.getenv("BOT_TOKEN"),
+            "database_url": os.getenv("DATABASE_URL"),
+            "webhook_url": os.getenv("WEBHOOK_URL"),
+            "mongo_profile": os.getenv("MONGO_PROFILE", "").lower() in ("1", "true", "yes"),
+            "match_ranking": os.getenv("MATCH_RANKING", "").lower() in ("1", "true", "yes"),
+        }
+        for name, variable, convert in [
+            ("database_name", "DATABASE_NAME", str),
+            ("log_level", "LOG_LEVEL", str.upper),
+            ("webhook_secret", "WEBHOOK_SECRET", str),
+            ("webhook_workers", "WEBHOOK_WORKERS", int),
+            ("port", "PORT", int),
+            ("mongo_max_pool_size", "MONGO_MAX_POOL_SIZE", int),
+            ("mongo_timeout_ms", "MONGO_TIMEOUT_MS", int),
+            ("db_thread_pool_size", "DB_THREAD_POOL_SIZE", int),
+            ("metrics_port", "METRICS_PORT", int),
+            ("metrics_host", "METRICS_HOST", str),
+            ("user_cache_size", "USER_CACHE_SIZE", int),
+            ("user_cache_ttl", "USER_CACHE_TTL", float),
+            ("outbound_workers", "OUTBOUND_WORKERS", int),
+            ("outbound_global_rate", "OUTBOUND_GLOBAL_RATE", float),
+            ("outbound_per_chat_rate", "OUTBOUND_PER_CHAT_RATE", float),
+            ("concurrent_updates", "CONCURRENT_UPDATES", int),
+            ("persistence_update_interval", "PERSISTENCE_UPDATE_INTERVAL", float),
+            ("write_buffer_interval", "WRITE_BUFFER_INTERVAL", float),
+            ("write_buffer_max_pending", "WRITE_BUFFER_MAX_PENDING", int),
+            ("match_candidates", "MATCH_CANDIDATES", int),
+            ("smart_match_poll_interval", "SMART_MATCH_POLL_INTERVAL", int),
+            ("smart_match_batch_size", "SMART_MATCH_BATCH_SIZE", int),
+            ("matching_sweep_interval", "MATCHING_SWEEP_INTERVAL", int),
+            ("user_sync_poll_interval", "USER_SYNC_POLL_INTERVAL", int),
+            ("startup_budget_ms", "STARTUP_BUDGET_MS", int),
+        ]:
+            value = os.getenv(variable)
+            if value:
+                settings[name] = convert(value)
+        return cls(**settings)
@@ -0,0 +1,481 @@
+import bisect
+import datetime
+import heapq
+import json
+from collections import OrderedDict
+
+from ranking import CandidateColumns, rank_candidates
+
+
+# Values of genderPreference that accept any gender
+ANY_GENDER = ["No preference", "Either"]
+
+# Smart-Match relaxation stages: each one relaxes one more preference, in this order,
+# until at FULLY_RELAXED the search is open to all players
+AGE_STAGE = 1  # Age range widened by AGE_WIDENING years on both ends
+SKILL_STAGE = 2  # Any skill level
+LOCATION_STAGE = 3  # Any location
+GENDER_STAGE = 4  # Any gender (and any age)
+FULLY_RELAXED = GENDER_STAGE
+AGE_WIDENING = 10
+
+
+class SportPreferences:
+    """Parsed match preferences for one sport.
+
+    gender is None when any gender is accepted; empty skill_levels or
+    locations accept everyone.
+    """
+
+    __slots__ = ("age_range", "gender", "skill_levels", "locations")
+
+    def __init__(self, age_range=(1, 100), gender=None, skill_levels=frozenset(), locations=frozenset()):
+        self.age_range = age_range
+        self.gender = gender
+        self.skill_levels = skill_levels
+        self.locations = locations
+
+    def __eq__(self, other):
+        return isinstance(other, SportPreferences) and (
+            (self.age_range, self.gender, self.skill_levels, self.locations)
+            == (other.age_range, other.gender, other.skill_levels, other.locations)
+        )
+
+    def __hash__(self):
+        return hash((self.age_range, self.gender, self.skill_levels, self.locations))
+
+    @classmethod
+    def from_dict(cls, sport_preferences):
+        try:
+            low, high = sport_preferences.get("ageRange", [1, 100])
+            age_range = (int(low), int(high))
+        except (TypeError, ValueError):
+            age_range = (1, 100)
+        gender = sport_preferences.get("genderPreference", "No preference")
+        return cls(
+            age_range=age_range,
+            gender=None if gender in ANY_GENDER else gender,
+            skill_levels=frozenset(sport_preferences.get("skillLevels") or []),
+            locations=frozenset(sport_preferences.get("locationPreferences") or []),
+        )
+
+
+# Preferences used for sports without saved preferences and for fully relaxed Smart-Match searches
+NO_PREFERENCES = SportPreferences()
+
+
+def age_range_at(preferences, stage):
+    low, high = preferences.age_range
+    if stage >= AGE_STAGE:
+        return (low - AGE_WIDENING, high + AGE_WIDENING)
+    return (low, high)
+
+
+def parse_match_preferences(raw):
+    """Parse a matchPreferences value (JSON string or dictionary) into {sport: SportPreferences}.
+
+    Returns None if the value is a string that is not valid JSON.
+    """
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+    if not isinstance(raw, dict):
+        return {}
+    return {
+        sport: SportPreferences.from_dict(sport_preferences)
+        for sport, sport_preferences in raw.items()
+        if isinstance(sport_preferences, dict)
+    }
+
+
+class PreferenceCache:
+    """LRU cache of parsed matchPreferences, keyed by telegramId.
+
+    A cached entry is only reused while the raw matchPreferences value in the
+    user document is unchanged, so edits made by the web apps invalidate it
+    as soon as the bot reads the new document.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, user):
+        telegram_id = user.get("telegramId")
+        raw = user.get("matchPreferences", {})
+        cached = self.entries.get(telegram_id)
+        if cached is not None and cached[0] == raw:
+            self.entries.move_to_end(telegram_id)
+            return cached[1]
+        preferences = parse_match_preferences(raw)
+        self.entries[telegram_id] = (raw, preferences)
+        self.entries.move_to_end(telegram_id)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return preferences
+
+    def invalidate(self, telegram_id):
+        self.entries.pop(telegram_id, None)
+
+
+class WaitingUser:
+    """A user waiting for a match in one sport, with everything needed to match them."""
+
+    __slots__ = (
+        "telegram_id", "sport", "age", "gender", "skill_level", "smart_match", "start_time",
+        "display_name", "username", "preferences", "stage",
+    )
+
+    def __init__(self, telegram_id, sport, age, gender, skill_level, smart_match, start_time,
+                 display_name, username, preferences, stage=0):
+        self.telegram_id = telegram_id
+        self.sport = sport
+        self.age = age
+        self.gender = gender
+        self.skill_level = skill_level
+        self.smart_match = smart_match
+        self.start_time = start_time
+        self.display_name = display_name
+        self.username = username
+        self.preferences = preferences
+        self.stage = stage  # Smart-Match relaxation stage of this user's search (0 = not relaxed)
+
+    def same_search(self, other):
+        """Check if other is matched exactly like this entry (only the names may differ)."""
+        return (
+            (self.age, self.gender, self.skill_level, self.smart_match, self.start_time, self.stage, self.preferences)
+            == (other.age, other.gender, other.skill_level, other.smart_match, other.start_time, other.stage,
+                other.preferences)
+        )
+
+    def accepts(self, other, stage=0):
+        """Check if this user's preferences, relaxed to `stage`, accept the other user
+        (location is checked separately)."""
+        if stage >= GENDER_STAGE:
+            return True
+        preferences = self.preferences
+        low, high = age_range_at(preferences, stage)
+        return (
+            (preferences.gender is None or other.gender == preferences.gender)
+            and low <= other.age <= high
+            and (stage >= SKILL_STAGE or not preferences.skill_levels or other.skill_level in preferences.skill_levels)
+        )
+
+
+class SportPool:
+    """The waiting users of one sport, bucketed by gender, skill level and location.
+
+    The members are also bucketed by the gender, skill level and location their
+    own search accepts (None when it accepts any), to look up whose search a
+    member appears in. With columns, the members' scoring attributes are also
+    kept in a CandidateColumns for vectorised ranking.
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.members = {}
+        self.smart_match = set()
+        self.by_gender = {}
+        self.by_skill = {}
+        self.by_location = {}
+        self.ages = []  # Sorted (age, telegramId) pairs for age-range lookups
+        self.wanted_genders = {}
+        self.wanted_skills = {}
+        self.wanted_locations = {}
+        self.changed = set()  # Members added or changed since take_changed() was last called
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, entry):
+        existing = self.members.get(entry.telegram_id)
+        if existing is not None and existing.same_search(entry):
+            self.members[entry.telegram_id] = entry
+            return
+        self.remove(entry.telegram_id)
+        self.members[entry.telegram_id] = entry
+        self.changed.add(entry.telegram_id)
+        if entry.smart_match:
+            self.smart_match.add(entry.telegram_id)
+        self.by_gender.setdefault(entry.gender, set()).add(entry.telegram_id)
+        self.by_skill.setdefault(entry.skill_level, set()).add(entry.telegram_id)
+        for location in entry.preferences.locations:
+            self.by_location.setdefault(location, set()).add(entry.telegram_id)
+        for buckets, keys in self._wanted(entry):
+            for key in keys:
+                buckets.setdefault(key, set()).add(entry.telegram_id)
+        bisect.insort(self.ages, (entry.age, entry.telegram_id))
+        if self.columns is not None:
+            self.columns.add(entry)
+
+    def remove(self, telegram_id):
+        entry = self.members.pop(telegram_id, None)
+        if entry is None:
+            return None
+        self.changed.discard(telegram_id)
+        self.smart_match.discard(telegram_id)
+        _discard(self.by_gender, entry.gender, telegram_id)
+        _discard(self.by_skill, entry.skill_level, telegram_id)
+        for location in entry.preferences.locations:
+            _discard(self.by_location, location, telegram_id)
+        for buckets, keys in self._wanted(entry):
+            for key in keys:
+                _discard(buckets, key, telegram_id)
+        index = bisect.bisect_left(self.ages, (entry.age, telegram_id))
+        if index < len(self.ages) and self.ages[index] == (entry.age, telegram_id):
+            del self.ages[index]
+        if self.columns is not None:
+            self.columns.remove(telegram_id)
+        return entry
+
+    def _wanted(self, entry):
+        """Yield (buckets, keys) for the gender, skill levels and locations entry's search accepts."""
+        preferences = entry.preferences
+        stage = entry.stage
+        relaxed_gender = stage >= GENDER_STAGE or preferences.gender is None
+        yield self.wanted_genders, [None] if relaxed_gender else [preferences.gender]
+        relaxed_skill = stage >= SKILL_STAGE or not preferences.skill_levels
+        yield self.wanted_skills, [None] if relaxed_skill else preferences.skill_levels
+        relaxed_location = stage >= LOCATION_STAGE or not preferences.locations
+        yield self.wanted_locations, [None] if relaxed_location else preferences.locations
+
+    def take_changed(self):
+        """Return the ids of the members added or changed since the last call."""
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def in_age_range(self, age_range, among=None):
+        """Return the ids of members whose age is within age_range (inclusive), only those in `among` when given."""
+        low = bisect.bisect_left(self.ages, (age_range[0], float("-inf")))
+        high = bisect.bisect_right(self.ages, (age_range[1], float("inf")))
+        if among is not None and len(among) < high - low:
+            # Fewer ids to check than members in the range
+            return {telegram_id for telegram_id in among if age_range[0] <= self.members[telegram_id].age <= age_range[1]}
+        in_range = {telegram_id for _, telegram_id in self.ages[low:high]}
+        return in_range if among is None else in_range & among
+
+    def candidate_ids(self, entry):
+        """Return the ids of Smart-Match members that the entry's own preferences accept.
+
+        Preferences relaxed by the entry's Smart-Match stage are left out of the
+        bucket intersection, so later stages only intersect fewer buckets.
+        """
+        buckets = [self.smart_match]
+        preferences = entry.preferences
+        stage = entry.stage
+        if stage < GENDER_STAGE and preferences.gender is not None:
+            buckets.append(self.by_gender.get(preferences.gender, set()))
+        if stage < SKILL_STAGE and preferences.skill_levels:
+            buckets.append(_union(self.by_skill, preferences.skill_levels))
+        if stage < LOCATION_STAGE and preferences.locations:
+            buckets.append(_union(self.by_location, preferences.locations))
+        # Intersect starting from the smallest buckets
+        buckets.sort(key=len)
+        candidates = buckets[0] & buckets[1] if len(buckets) > 1 else set(buckets[0])
+        for bucket in buckets[2:]:
+            if not candidates:
+                return candidates
+            candidates &= bucket
+        if stage < GENDER_STAGE and candidates:
+            candidates = self.in_age_range(age_range_at(preferences, stage), candidates)
+        candidates.discard(entry.telegram_id)
+        return candidates
+
+    def includes(self, entry, member):
+        """Check if member is one of entry's candidate_ids(), without building the buckets."""
+        if member.telegram_id == entry.telegram_id or member.telegram_id not in self.smart_match:
+            return False
+        preferences = entry.preferences
+        stage = entry.stage
+        if stage >= GENDER_STAGE:
+            return True
+        low, high = age_range_at(preferences, stage)
+        return (
+            (preferences.gender is None or member.gender == preferences.gender)
+            and (stage >= SKILL_STAGE or not preferences.skill_levels or member.skill_level in preferences.skill_levels)
+            and (stage >= LOCATION_STAGE or not preferences.locations
+                 or not preferences.locations.isdisjoint(member.preferences.locations))
+            and low <= member.age <= high
+        )
+
+    def searcher_ids(self, member):
+        """Return the ids of the members whose candidate_ids() include member."""
+        if member.telegram_id not in self.smart_match:
+            return set()
+        buckets = [
+            _union(self.wanted_genders, [None, member.gender]),
+            _union(self.wanted_skills, [None, member.skill_level]),
+            _union(self.wanted_locations, [None, *member.preferences.locations]),
+        ]
+        buckets.sort(key=len)
+        searchers = set(buckets[0])
+        for bucket in buckets[1:]:
+            searchers &= bucket
+        searchers.discard(member.telegram_id)
+        result = set()
+        for telegram_id in searchers:
+            searcher = self.members[telegram_id]
+            low, high = age_range_at(searcher.preferences, searcher.stage)
+            if searcher.stage >= GENDER_STAGE or low <= member.age <= high:
+                result.add(telegram_id)
+        return result
+
+
+class MatchingEngine:
+    """In-process index of every user waiting for a match, keyed by sport.
+
+    A user can wait in several sports at once, with one entry per sport.
+    MongoDB stays the source of truth: the engine is loaded from it on startup
+    and kept up to date as users start and stop searching.
+
+    Candidates are offered longest waiting first, or with ranking on, best
+    scored first (see ranking.py).
+    """
+
+    def __init__(self, ranking=False):
+        self.ranking = ranking
+        self.pools = {}
+        self.sports = {}  # telegramId -> sports the user waits in
+
+    def pool(self, sport):
+        pool = self.pools.get(sport)
+        if pool is None:
+            pool = self.pools[sport] = SportPool(CandidateColumns() if self.ranking else None)
+        return pool
+
+    def add(self, entry):
+        """Add or replace the user's entry in entry.sport (their other sports are kept)."""
+        self.pool(entry.sport).add(entry)
+        self.sports.setdefault(entry.telegram_id, set()).add(entry.sport)
+
+    def load(self, entries):
+        """Make the engine hold exactly these entries.
+
+        Entries that are unchanged stay as they are, so the next sweep doesn't
+        search for them again.
+        """
+        loaded = set()
+        for entry in entries:
+            self.add(entry)
+            loaded.add((entry.telegram_id, entry.sport))
+        for telegram_id, sports in list(self.sports.items()):
+            for sport in list(sports):
+                if (telegram_id, sport) not in loaded:
+                    self.remove(telegram_id, sport)
+
+    def mark_changed(self, telegram_id, sport):
+        """Have the next sweep search for the user's entry again, e.g. after their match failed."""
+        pool = self.pools.get(sport)
+        if pool is not None and telegram_id in pool.members:
+            pool.changed.add(telegram_id)
+
+    def remove(self, telegram_id, sport=None):
+        """Remove the user from one sport, or from every sport they wait in."""
+        sports = self.sports.get(telegram_id)
+        if not sports:
+            return
+        for waiting_sport in [sport] if sport is not None else list(sports):
+            pool = self.pools.get(waiting_sport)
+            if pool is not None:
+                pool.remove(telegram_id)
+            sports.discard(waiting_sport)
+        if not sports:
+            del self.sports[telegram_id]
+
+    def waiting_sports(self, telegram_id):
+        return set(self.sports.get(telegram_id, ()))
+
+    def waiting_ids(self):
+        return set(self.sports)
+
+    def find_candidates(self, entry, limit=None, exclude=(), among=None):
+        """Return the waiting users that mutually accept entry, best first.
+
+        Both sides' preferences are relaxed to the entry's Smart-Match stage.
+        Only the first `limit` are returned when given; users in `exclude`
+        are skipped, and only users in `among` are considered when given.
+        """
+        pool = self.pools.get(entry.sport)
+        if not pool:
+            return []
+        if among is None:
+            candidate_ids = pool.candidate_ids(entry)
+        else:
+            candidate_ids = {
+                telegram_id for telegram_id in among
+                if telegram_id in pool.members and pool.includes(entry, pool.members[telegram_id])
+            }
+        if exclude:
+            candidate_ids -= exclude
+        candidates = [pool.members[telegram_id] for telegram_id in candidate_ids]
+        if entry.stage < FULLY_RELAXED:
+            candidates = [candidate for candidate in candidates if candidate.accepts(entry, entry.stage)]
+        if self.ranking:
+            return rank_candidates(entry, candidates, pool.columns, limit)
+        if limit:
+            return heapq.nsmallest(limit, candidates, key=_wait_order)
+        candidates.sort(key=_wait_order)
+        return candidates
+
+    def find_pairs(self, sport):
+        """Greedily pair up the waiting users of a sport, see iter_pairs()."""
+        return [(entry, candidate) for entry, candidate in self.iter_pairs(sport) if candidate is not None]
+
+    def iter_pairs(self, sport):
+        """Greedily pair up the waiting users of a sport whose entries changed since the last call.
+
+        Pairs of unchanged entries were already found incompatible, so only the
+        changed entries search the whole pool, and the unchanged users whose
+        search includes a changed entry search among the changed entries.
+        Users are visited longest waiting first and paired with their best
+        available candidate, as if each had searched in that order; Smart-Match
+        users search with preferences relaxed to their stage.
+
+        Yields (entry, candidate or None) for every user visited, so callers
+        can pause between them; the pool may change while paused.
+        """
+        pool = self.pools.get(sport)
+        if not pool:
+            return
+        changed = pool.take_changed()
+        if 2 * len(changed) >= len(pool):
+            # Most entries changed (e.g. on startup), so looking up whose search includes
+            # each of them would cost more than everyone searching the whole pool
+            among = dict.fromkeys(pool.members)
+        else:
+            among = dict.fromkeys(changed)  # telegramId -> users to search among (None for the whole pool)
+            for telegram_id in changed:
+                for searcher_id in pool.searcher_ids(pool.members[telegram_id]) - changed:
+                    among.setdefault(searcher_id, set()).add(telegram_id)
+        paired = set()
+        for telegram_id in sorted(among, key=lambda telegram_id: _wait_order(pool.members[telegram_id])):
+            entry = pool.members.get(telegram_id)
+            if entry is None or telegram_id in paired:
+                continue
+            candidates = self.find_candidates(entry, limit=1, exclude=paired, among=among[telegram_id])
+            if candidates:
+                paired.update((telegram_id, candidates[0].telegram_id))
+                yield entry, candidates[0]
+            else:
+                yield entry, None
+
+
+def _wait_order(entry):
+    return entry.start_time or datetime.datetime.min
+
+
+def _discard(buckets, key, telegram_id):
+    bucket = buckets.get(key)
+    if bucket is not None:
+        bucket.discard(telegram_id)
+        if not bucket:
+            del buckets[key]
+
+
+def _union(buckets, keys):
+    result = set()
+    for key in keys:
+        result |= buckets.get(key, set())
+    return result
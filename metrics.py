@@ -0,0 +1,149 @@
+import bisect
+import contextvars
+import functools
+import time
+
+
+# Name of the handler (or job) the current task is running, used to attribute MongoDB calls
+current_handler = contextvars.ContextVar("current_handler", default="none")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label_value(value):
+    # The text format escapes backslashes, double quotes and line feeds in label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=""):
+    labels = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_bucket{bucket_labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-2]}")
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Gauge read when the metrics are scraped; collect() returns {label values: value}."""
+
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, collect, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+        self.label_names = label_names
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        for label_values, value in self.collect().items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class CollectedCounter(Gauge):
+    """Counter kept elsewhere and read when the metrics are scraped, like Gauge."""
+
+    type_name = "counter"
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered in the Prometheus text format.
+
+    When disabled nothing is recorded and instrumented() returns functions
+    unchanged, so instrumentation costs nothing.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.metrics = []
+        self.handler_seconds = self.register(Histogram(
+            "sportsfinder_handler_seconds", "Time spent in each handler or job", ("handler",)))
+        self.handler_errors = self.register(Counter(
+            "sportsfinder_handler_errors_total", "Exceptions raised by each handler or job", ("handler",)))
+        self.mongo_seconds = self.register(Histogram(
+            "sportsfinder_mongo_operation_seconds", "MongoDB operation latency",
+            ("handler", "collection", "operation")))
+        self.telegram_seconds = self.register(Histogram(
+            "sportsfinder_telegram_api_seconds", "Telegram API latency of outbound messages"))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def instrumented(self, function):
+        """Decorator timing an async handler or job and attributing its MongoDB calls to it."""
+        if not self.enabled:
+            return function
+        name = function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            token = current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - started, name)
+                current_handler.reset(token)
+
+        return wrapper
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` operations per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundMessage:
+    __slots__ = ("kwargs", "future", "attempts")
+
+    def __init__(self, kwargs, future):
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """Central queue for messages sent by the bot.
+
+    Messages are delivered by a pool of workers, limited by a global token
+    bucket and a per-chat token bucket, so bursts go out as fast as Telegram
+    allows without handlers waiting on the API. Messages to the same chat are
+    always delivered in the order they were queued. Flood-control (429)
+    responses pause sending for the requested time and the message is retried.
+    """
+
+    def __init__(self, workers=8, global_rate=30, per_chat_rate=1, per_chat_burst=3, max_retries=3, observe_latency=None):
+        self.bot = None
+        self.observe_latency = observe_latency  # Called with the duration of every send_message call
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.chat_queues = {}  # chat_id -> deque of pending messages
+        self.ready = None  # Chats with pending messages and no worker on them
+        self.paused_until = 0.0
+        self.tasks = []
+        self.metrics = {"queued": 0, "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0}
+
+    @property
+    def queue_depth(self):
+        return sum(len(pending) for pending in self.chat_queues.values())
+
+    def start(self, bot):
+        self.bot = bot
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._evict_idle_buckets()))
+
+    async def stop(self, timeout=10):
+        # Give queued messages a chance to go out before shutting down
+        deadline = time.monotonic() + timeout
+        while self.chat_queues and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Queue a message. Returns a future resolved with the sent Message (or the error)."""
+        future = asyncio.get_running_loop().create_future()
+        # Most callers never await delivery; errors are already reported by the dispatcher
+        future.add_done_callback(_consume_exception)
+        message = OutboundMessage(dict(chat_id=chat_id, text=text, **kwargs), future)
+        self.metrics["queued"] += 1
+        pending = self.chat_queues.get(chat_id)
+        if pending is None:
+            self.chat_queues[chat_id] = deque([message])
+            self.ready.put_nowait(chat_id)
+        else:
+            # A worker (or the ready queue) already holds this chat
+            pending.append(message)
+        return future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def _evict_idle_buckets(self):
+        # A bucket that has refilled completely behaves exactly like a new one, so the
+        # buckets of chats with nothing pending are dropped once they are full again
+        # (the worker can't do it right after a send, when a token was just spent)
+        interval = max(1.0, self.per_chat_burst / self.per_chat_rate)
+        while True:
+            await asyncio.sleep(interval)
+            idle = [
+                chat_id for chat_id, bucket in self.chat_buckets.items()
+                if chat_id not in self.chat_queues and bucket.is_full()
+            ]
+            for chat_id in idle:
+                del self.chat_buckets[chat_id]
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            pending = self.chat_queues[chat_id]
+            message = pending[0]
+            try:
+                await self._deliver(chat_id, message)
+            finally:
+                if message.future.done():
+                    pending.popleft()
+                if pending:
+                    self.ready.put_nowait(chat_id)
+                else:
+                    del self.chat_queues[chat_id]
+                    if self._chat_bucket(chat_id).is_full():
+                        del self.chat_buckets[chat_id]
+
+    async def _deliver(self, chat_id, message):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+        message.attempts += 1
+        started = time.perf_counter()
+        try:
+            result = await self.bot.send_message(**message.kwargs)
+        except RetryAfter as e:
+            # Flood control applies to the whole bot, so pause every worker
+            self.metrics["rate_limited"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            self._retry_or_fail(message, e)
+        except (TimedOut, NetworkError) as e:
+            if self._retry_or_fail(message, e):
+                await asyncio.sleep(min(2 ** message.attempts, 30))
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logger.error("Error sending message to %s: %s", chat_id, e)
+            message.future.set_exception(e)
+        else:
+            self.metrics["sent"] += 1
+            message.future.set_result(result)
+        finally:
+            if self.observe_latency is not None:
+                self.observe_latency(time.perf_counter() - started)
+
+    def _retry_or_fail(self, message, error):
+        # Leaving the future pending keeps the message at the head of its chat queue
+        if message.attempts <= self.max_retries:
+            self.metrics["retried"] += 1
+            return True
+        self.metrics["failed"] += 1
+        logger.error("Giving up sending message to %s: %s", message.kwargs["chat_id"], error)
+        message.future.set_exception(error)
+        return False
+
+
+def _consume_exception(future):
+    if not future.cancelled():
+        future.exception()
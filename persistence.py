@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+logger = logging.getLogger(__name__)
+
+
+class MongoPersistence(BasePersistence):
+    """Stores user_data and ConversationHandler states in a MongoDB collection.
+
+    The Application hands over the data that changed every update_interval
+    seconds; those changes are coalesced per document and written with a
+    single bulk_write, so persistence costs no database write per update.
+
+    Documents are {"_id": "user_data:<user id>", "data": {...}} and
+    {"_id": "conversation:<name>:<key>", "name": ..., "key": [...], "state": ...}.
+    user_data keys must therefore be strings.
+
+    chat_data, bot_data (which holds the webhook worker's index) and
+    callback_data aren't stored. Webhook workers route every user to the
+    same worker, so each user's state only ever changes in one process.
+    """
+
+    def __init__(self, collection, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.collection = collection  # AsyncCollection
+        self.pending = {}  # _id -> pending write, the latest one wins
+        self.write_task = None
+
+    async def get_user_data(self):
+        documents = await self.collection.find({"_id": {"$regex": "^user_data:"}})
+        return {int(document["_id"].split(":", 1)[1]): document["data"] for document in documents}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        documents = await self.collection.find({"name": name}, {"key": 1, "state": 1})
+        return {tuple(document["key"]): document["state"] for document in documents}
+
+    async def update_conversation(self, name, key, new_state):
+        document_id = f"conversation:{name}:{':'.join(map(str, key))}"
+        if new_state is None:
+            self._queue(document_id, DeleteOne({"_id": document_id}))
+        else:
+            self._queue(document_id, UpdateOne(
+                {"_id": document_id},
+                {"$set": {"name": name, "key": list(key), "state": new_state}},
+                upsert=True,
+            ))
+
+    async def update_user_data(self, user_id, data):
+        document_id = f"user_data:{user_id}"
+        self._queue(document_id, UpdateOne({"_id": document_id}, {"$set": {"data": data}}, upsert=True))
+
+    async def drop_user_data(self, user_id):
+        document_id = f"user_data:{user_id}"
+        self._queue(document_id, DeleteOne({"_id": document_id}))
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self.write_task:
+            await self.write_task
+        await self._write()
+
+    def _queue(self, document_id, request):
+        self.pending[document_id] = request
+        # The Application passes all of a round's changes at once, so wait for
+        # the rest of them before writing
+        if self.write_task is None:
+            self.write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        try:
+            await asyncio.sleep(0)
+            await self._write()
+        finally:
+            self.write_task = None
+
+    async def _write(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await self.collection.bulk_write(list(batch.values()), ordered=False)
+        except Exception:
+            logger.exception("Error writing %d persistence changes", len(batch))
+            # Retried with the next round, unless a newer change replaced them
+            for document_id, request in batch.items():
+                self.pending.setdefault(document_id, request)
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import time
+
+from pymongo.errors import PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+# Operations whose first argument is a query filter
+FILTERED_OPERATIONS = {"find", "find_one", "update_one", "update_many", "find_one_and_update"}
+READ_OPERATIONS = {"find", "find_one"}
+
+# Operations recorded for the update the current task is processing (None outside an update)
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def query_shape(value):
+    """Return the filter with every value replaced by "?", keeping field names and operators."""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and any(isinstance(item, dict) for item in value):
+        # e.g. $or / $and clauses
+        return [query_shape(item) for item in value]
+    return "?"
+
+
+def plan_stages(plan):
+    """Yield the stage names of an explain() query plan tree."""
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+class ProfiledOperation:
+    __slots__ = ("collection", "operation", "query", "shape", "seconds", "index_use")
+
+    def __init__(self, collection, operation, query, shape, seconds, index_use):
+        self.collection = collection
+        self.operation = operation
+        self.query = query
+        self.shape = shape
+        self.seconds = seconds
+        self.index_use = index_use
+
+
+class MongoProfiler:
+    """Records the MongoDB operations of each update and logs a report when it's done.
+
+    The report lists every operation with its filter shape, duration and
+    whether the filter can use an index, and calls out reads repeated within
+    the update (N+1 patterns) and collection scans. Index use is checked
+    once per query shape with explain() on a find with the same filter.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.index_use = {}  # (collection, shape) -> "index", "COLLSCAN" or "unknown"
+
+    @contextlib.contextmanager
+    def profile(self, label):
+        operations = []
+        token = current_profile.set(operations)
+        started = time.perf_counter()
+        try:
+            yield operations
+        finally:
+            current_profile.reset(token)
+            if operations:
+                self.report(label, operations, time.perf_counter() - started)
+
+    async def record(self, collection, operation, args, kwargs, seconds):
+        operations = current_profile.get()
+        if operations is None:
+            return
+        query = None
+        shape = None
+        index_use = None
+        if operation in FILTERED_OPERATIONS:
+            query = args[0] if args else kwargs.get("filter", {})
+            shape = json.dumps(query_shape(query), sort_keys=True)
+            index_use = await self._index_use(collection, query, shape)
+        operations.append(ProfiledOperation(collection.name, operation, query, shape, seconds, index_use))
+
+    async def _index_use(self, collection, query, shape):
+        key = (collection.name, shape)
+        if key not in self.index_use:
+            loop = asyncio.get_running_loop()
+            self.index_use[key] = await loop.run_in_executor(self.executor, self._explain, collection, query)
+        return self.index_use[key]
+
+    def _explain(self, collection, query):
+        try:
+            plan = collection.find(query).explain()["queryPlanner"]["winningPlan"]
+        except (PyMongoError, AttributeError, KeyError):
+            # e.g. mongomock, which can't explain queries
+            return "unknown"
+        # Sharded clusters report one winning plan per shard
+        plans = [shard["winningPlan"] for shard in plan["shards"]] if "shards" in plan else [plan]
+        stages = {stage for plan in plans for stage in plan_stages(plan)}
+        return "COLLSCAN" if "COLLSCAN" in stages else "index"
+
+    def report(self, label, operations, seconds):
+        lines = [f"MongoDB profile of {label}: {len(operations)} operations, "
+                 f"{sum(op.seconds for op in operations) * 1000:.1f} ms of {seconds * 1000:.1f} ms"]
+        for op in operations:
+            lines.append(f"  {op.collection}.{op.operation} {op.shape or ''} "
+                         f"{op.seconds * 1000:.1f} ms {op.index_use or ''}".rstrip())
+
+        reads = {}
+        for op in operations:
+            if op.operation in READ_OPERATIONS:
+                key = (op.collection, op.operation, repr(op.query))
+                reads[key] = reads.get(key, 0) + 1
+        problems = [f"  duplicate read: {collection}.{operation} {query} x{count}"
+                    for (collection, operation, query), count in reads.items() if count > 1]
+        scans = {(op.collection, op.operation, op.shape) for op in operations if op.index_use == "COLLSCAN"}
+        problems.extend(f"  collection scan: {collection}.{operation} {shape}"
+                        for collection, operation, shape in sorted(scans))
+
+        logger.log(logging.WARNING if problems else logging.INFO, "\n".join(lines + problems))
@@ -0,0 +1,194 @@
+import datetime
+import heapq
+from array import array
+
+numpy = None  # Imported by load_numpy() the first time candidates are ranked
+_numpy_loaded = False
+
+
+# Skill levels in increasing order, for skill closeness
+SKILL_ORDER = {"Beginner": 0, "Intermediate": 1, "Advanced": 2}
+UNKNOWN_SKILL = -1.0
+
+# Weights of the score components, each of which is between 0 and 1
+SKILL_WEIGHT = 3.0
+AGE_WEIGHT = 2.0
+LOCATION_WEIGHT = 2.0
+WAIT_WEIGHT = 1.0
+
+AGE_SCALE = 20.0  # Years apart at which age closeness reaches 0
+WAIT_SCALE = 3600.0  # Seconds of waiting that earn the full wait score
+MAX_LOCATIONS = 63  # Locations per pool tracked in the location bitmasks
+
+# Below this many candidates the pure Python scoring is faster than numpy
+VECTORISE_MIN = 64
+
+
+def load_numpy():
+    """Import numpy on first use, as importing it slows startup; None when it isn't installed."""
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy as module
+        except ImportError:  # Candidates are scored in pure Python instead
+            module = None
+        numpy, _numpy_loaded = module, True
+    return numpy
+
+
+def skill_code(skill_level):
+    return float(SKILL_ORDER.get(skill_level, UNKNOWN_SKILL))
+
+
+def start_timestamp(entry, now):
+    return entry.start_time.timestamp() if entry.start_time else now
+
+
+def wait_key(entry):
+    """Start of the entry's wait, for breaking ties in favour of the longest waiting."""
+    return entry.start_time.timestamp() if entry.start_time else float("-inf")
+
+
+def score(entry, candidate, now):
+    """How good a match candidate is for entry (higher is better)."""
+    entry_skill, candidate_skill = skill_code(entry.skill_level), skill_code(candidate.skill_level)
+    if entry_skill == UNKNOWN_SKILL or candidate_skill == UNKNOWN_SKILL:
+        skill_closeness = 0.5
+    else:
+        skill_closeness = 1 - abs(entry_skill - candidate_skill) / 2
+    age_closeness = max(0.0, 1 - abs(entry.age - candidate.age) / AGE_SCALE)
+    locations = entry.preferences.locations
+    location_overlap = len(locations & candidate.preferences.locations) / len(locations) if locations else 0.0
+    wait = min(max(now - start_timestamp(candidate, now), 0.0), WAIT_SCALE) / WAIT_SCALE
+    return (
+        SKILL_WEIGHT * skill_closeness
+        + AGE_WEIGHT * age_closeness
+        + LOCATION_WEIGHT * location_overlap
+        + WAIT_WEIGHT * wait
+    )
+
+
+class CandidateColumns:
+    """Array-backed copy of a sport pool's scoring attributes, one row per waiting user.
+
+    Lets numpy score many candidates at once; rows are removed by moving the
+    last row into the gap.
+    """
+
+    def __init__(self):
+        self.rows = {}  # telegramId -> row
+        self.ids = []
+        self.ages = array("d")
+        self.skills = array("d")
+        self.start_times = array("d")
+        self.locations = array("q")  # Bitmask of preferred locations
+        self.location_bits = {}
+
+    def location_mask(self, locations):
+        mask = 0
+        for location in locations:
+            bit = self.location_bits.get(location)
+            if bit is None:
+                if len(self.location_bits) >= MAX_LOCATIONS:
+                    continue  # Not tracked, so it doesn't count towards the overlap
+                bit = self.location_bits[location] = len(self.location_bits)
+            mask |= 1 << bit
+        return mask
+
+    def add(self, entry):
+        self.remove(entry.telegram_id)
+        self.rows[entry.telegram_id] = len(self.ids)
+        self.ids.append(entry.telegram_id)
+        self.ages.append(entry.age)
+        self.skills.append(skill_code(entry.skill_level))
+        self.start_times.append(entry.start_time.timestamp() if entry.start_time else float("nan"))
+        self.locations.append(self.location_mask(entry.preferences.locations))
+
+    def remove(self, telegram_id):
+        row = self.rows.pop(telegram_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            moved_id = self.ids[last]
+            self.rows[moved_id] = row
+            self.ids[row] = moved_id
+            for column in (self.ages, self.skills, self.start_times, self.locations):
+                column[row] = column[last]
+        for column in (self.ids, self.ages, self.skills, self.start_times, self.locations):
+            column.pop()
+
+    def rows_of(self, candidates):
+        numpy = load_numpy()
+        return numpy.fromiter((self.rows[c.telegram_id] for c in candidates), dtype=numpy.int64, count=len(candidates))
+
+    def wait_keys(self, rows):
+        """wait_key() of the given rows."""
+        numpy = load_numpy()
+        start_times = numpy.frombuffer(self.start_times, dtype=numpy.float64)[rows]
+        return numpy.where(numpy.isnan(start_times), -numpy.inf, start_times)
+
+    def scores(self, entry, rows, now):
+        numpy = load_numpy()
+        ages = numpy.frombuffer(self.ages, dtype=numpy.float64)[rows]
+        skills = numpy.frombuffer(self.skills, dtype=numpy.float64)[rows]
+        start_times = numpy.frombuffer(self.start_times, dtype=numpy.float64)[rows]
+        locations = numpy.frombuffer(self.locations, dtype=numpy.int64)[rows]
+
+        entry_skill = skill_code(entry.skill_level)
+        if entry_skill == UNKNOWN_SKILL:
+            skill_closeness = numpy.full(len(rows), 0.5)
+        else:
+            skill_closeness = numpy.where(skills == UNKNOWN_SKILL, 0.5, 1 - numpy.abs(skills - entry_skill) / 2)
+        age_closeness = numpy.clip(1 - numpy.abs(ages - entry.age) / AGE_SCALE, 0.0, None)
+
+        location_overlap = numpy.zeros(len(rows))
+        entry_locations = entry.preferences.locations
+        if entry_locations:
+            for location in entry_locations:
+                bit = self.location_bits.get(location)
+                if bit is not None:
+                    location_overlap += (locations >> bit) & 1
+            location_overlap /= len(entry_locations)
+
+        start_times = numpy.where(numpy.isnan(start_times), now, start_times)
+        wait = numpy.clip(now - start_times, 0.0, WAIT_SCALE) / WAIT_SCALE
+        return (
+            SKILL_WEIGHT * skill_closeness
+            + AGE_WEIGHT * age_closeness
+            + LOCATION_WEIGHT * location_overlap
+            + WAIT_WEIGHT * wait
+        )
+
+
+def rank_candidates(entry, candidates, columns=None, limit=None):
+    """Return the candidates best match first, only the best `limit` when given.
+
+    Equal scores go to the longest waiting candidate, then to the one that
+    came first. Scoring is done with numpy over the pool's CandidateColumns
+    when both are available.
+    """
+    if not candidates:
+        return []
+    now = datetime.datetime.now().timestamp()
+    if columns is not None and len(candidates) >= VECTORISE_MIN and load_numpy() is not None:
+        rows = columns.rows_of(candidates)
+        scores = columns.scores(entry, rows, now)
+        if limit and limit < len(candidates):
+            # Every candidate tied with the limit-th best score is kept, so wait time
+            # and then input order decide between them as in the pure Python path
+            kth_score = -numpy.partition(-scores, limit - 1)[limit - 1]
+            top = numpy.flatnonzero(scores >= kth_score)
+        else:
+            top = numpy.arange(len(candidates))
+        order = top[numpy.lexsort((top, columns.wait_keys(rows[top]), -scores[top]))][:limit]
+        return [candidates[index] for index in order]
+
+    scores = [score(entry, candidate, now) for candidate in candidates]
+    waits = [wait_key(candidate) for candidate in candidates]
+    key = lambda index: (scores[index], -waits[index], -index)
+    if limit and limit < len(candidates):
+        order = heapq.nlargest(limit, range(len(candidates)), key=key)
+    else:
+        order = sorted(range(len(candidates)), key=key, reverse=True)
+    return [candidates[index] for index in order]
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+# Server error codes meaning change streams are unavailable (standalone server / no oplog)
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+
+
+class ChangeStreamListener:
+    """Follows a database change stream in a background thread.
+
+    Every insert, update and replace in the watched collections is handed to
+    on_change on the event loop, with the full document (restricted to
+    `fields`). When the server doesn't support change streams (a standalone
+    mongod) `supported` ends up False and the listener stops, so the caller
+    can fall back to polling.
+    """
+
+    def __init__(self, db, loop, collections, fields, on_change):
+        self.db = db
+        self.loop = loop
+        self.on_change = on_change
+        self.pipeline = [
+            {"$match": {
+                "ns.coll": {"$in": collections},
+                "operationType": {"$in": ["insert", "update", "replace"]},
+            }},
+            {"$project": {
+                "ns": 1,
+                "operationType": 1,
+                **{f"fullDocument.{field}": 1 for field in fields},
+            }},
+        ]
+        self.supported = None
+        self.started = threading.Event()  # Set once `supported` is known
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="change-stream", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        resume_token = None
+        while not self.stopping.is_set():
+            try:
+                with self.db.watch(
+                    self.pipeline,
+                    full_document="updateLookup",
+                    resume_after=resume_token,
+                    max_await_time_ms=1000,
+                ) as stream:
+                    self.supported = True
+                    self.started.set()
+                    while not self.stopping.is_set():
+                        change = stream.try_next()
+                        resume_token = stream.resume_token
+                        if change is not None:
+                            self.loop.call_soon_threadsafe(self.on_change, change)
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    self.supported = False
+                    self.started.set()
+                    return
+                # e.g. the resume point is no longer in the oplog, start from now
+                logger.warning("Change stream error, restarting: %s", e)
+                resume_token = None
+                time.sleep(5)
+            except PyMongoError as e:
+                logger.warning("Change stream error, restarting: %s", e)
+                time.sleep(5)
@@ -0,0 +1,120 @@
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+import callbacks
+
+
+# Web apps for viewing and editing profiles and match preferences
+PROFILE_WEB_APP = WebAppInfo("https://test-webapp-sportsfinder.vercel.app/")
+EDIT_PROFILE_WEB_APP = WebAppInfo("https://test-webapp-profile-sportsfinder.vercel.app/")
+EDIT_MATCH_PREFERENCES_WEB_APP = WebAppInfo("https://test-webapp-matchpreferences-sportsfinder.vercel.app/")
+MATCH_PREFERENCES_WEB_APP = WebAppInfo("https://webapp-matchpreferences-sportsfinder.vercel.app/")
+
+# Mapping reason numbers to their full text descriptions
+NO_GAME_REASONS = {
+    "1": "Couldn’t find a common date",
+    "2": "Match was unresponsive/unwilling to play",
+    "3": "Uncomfortable with other player",
+    "4": "Decided not to play",
+    "5": "Others"
+}
+
+# Messages; the ones with {fields} are filled in with str.format
+WELCOME_NEW_USER = (
+    "Welcome to SportsFinder!\n\n"
+    "This is a player matching service for your favourite sports. "
+    "To begin, click on the button below to open our web app - "
+    "it’ll give you access to view and edit your profile from there!"
+)
+WELCOME_BACK = (
+    "Welcome back, {first_name}!\n\n"
+    "SportsFinder is a player matching bot for your favourite sports! Click the commands below to edit your profile or match preferences! "
+)
+EDIT_PROFILE = "Hi {display_name}! Click on the respective buttons below to edit bio or match preferences!"
+MATCH_PREFERENCES = (
+    "Hi {first_name}, you can click on the button below to open the web app! "
+    "It’ll give you access to view and edit your match preferences from there!"
+)
+CHOOSE_SPORT = "Ready for your next game? Which sport are you looking to find a player for:"
+SMART_MATCH_QUESTION = (
+    "Do you want Smart-Match on for {sport}?\n\n"
+    "If no one is found within 1 hour, your match preference opens up to all options until you find a match."
+)
+# Sent when a Smart-Match search moves on to a relaxation stage (see matching.py)
+SMART_MATCH_STAGES = {
+    1: "⏳ Still looking for a match for {sports}. Now also considering players a little outside your preferred age range!",
+    2: "⏳ Still looking for a match for {sports}. Now also considering players of any skill level!",
+    3: "⏳ Still looking for a match for {sports}. Now also considering players in any location!",
+    4: "⏳ Couldn't find a strict match for {sports} after 1 hour. Now expanding search to all available players with Smart-Match ON!",
+}
+END_SEARCH = "You are currently searching for matches! Click the button below to stop searching:"
+GAME_PLAYED_QUESTION = "Was a game played?"
+BOT_EXPERIENCE_QUESTION = "How was your experience using SportsFinder’s bot?"
+USER_EXPERIENCE_QUESTION = "How was your experience with {display_name}?"
+NO_GAME_REASON_QUESTION = "Sorry to hear that! Why wasn’t a game played?"
+
+# Keyboards without per-call values, built once (telegram objects are immutable, so
+# the same markup can be sent any number of times)
+WELCOME_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("My Profile", web_app=PROFILE_WEB_APP)]])
+EDIT_PROFILE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Edit Profile", web_app=EDIT_PROFILE_WEB_APP)],
+    [InlineKeyboardButton("Edit Match Preferences", web_app=EDIT_MATCH_PREFERENCES_WEB_APP)]
+])
+MATCH_PREFERENCES_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Edit Match Preferences", web_app=MATCH_PREFERENCES_WEB_APP)]
+])
+
+
+class MatchKeyboard:
+    """One-button-per-row keyboard answering a question about a match.
+
+    The labels and answer values are fixed; render() only stamps the match,
+    the user's side of it and their partner into the callback data.
+    """
+
+    def __init__(self, action, options):
+        self.action = action
+        self.options = options  # (label, value) pairs
+
+    def render(self, match_id, role, partner_id):
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(label, callback_data=callbacks.encode(self.action, match_id, role, partner_id, value))]
+            for label, value in self.options
+        ])
+
+
+STARS = [(f"⭐ {rating}", rating) for rating in range(1, 6)]
+GAME_PLAYED_KEYBOARD = MatchKeyboard(callbacks.GAME_PLAYED, [("Yes", 1), ("No", 0)])
+BOT_EXPERIENCE_KEYBOARD = MatchKeyboard(callbacks.BOT_EXPERIENCE, STARS)
+USER_EXPERIENCE_KEYBOARD = MatchKeyboard(callbacks.USER_EXPERIENCE, STARS)
+NO_GAME_REASON_KEYBOARD = MatchKeyboard(
+    callbacks.NO_GAME_REASON, [(reason_text, int(reason)) for reason, reason_text in NO_GAME_REASONS.items()]
+)
+
+
+# Keyboards that only depend on sports are built once per sport (or list of sports)
+@lru_cache(maxsize=1024)
+def sport_keyboard(sports):
+    """Sport selection keyboard for a tuple of sports."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(sport, callback_data=callbacks.encode(callbacks.SPORT, sport=sport))]
+        for sport in sports
+    ])
+
+
+@lru_cache(maxsize=256)
+def smart_match_keyboard(sport):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("On", callback_data=callbacks.encode(callbacks.SMART_MATCH, value=1, sport=sport))],
+        [InlineKeyboardButton("Off", callback_data=callbacks.encode(callbacks.SMART_MATCH, value=0, sport=sport))]
+    ])
+
+
+@lru_cache(maxsize=1024)
+def end_search_keyboard(sports):
+    """End search keyboard for a tuple of sports being searched for."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(sport, callback_data=callbacks.encode(callbacks.END_SEARCH, sport=sport))]
+        for sport in sports
+    ])
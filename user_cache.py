@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """Bounded LRU cache of user documents keyed by telegramId, with a TTL.
+
+    The TTL bounds how long an edit made outside the bot (e.g. in the web
+    apps) can go unnoticed; the bot's own writes are applied to the cached
+    documents as they happen.
+    """
+
+    def __init__(self, max_size=5000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # telegramId -> (expiry time, document)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, telegram_id):
+        entry = self.entries.get(telegram_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(telegram_id, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(telegram_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user):
+        telegram_id = user.get("telegramId")
+        if telegram_id is None:
+            return
+        self.entries[telegram_id] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(telegram_id)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def refresh(self, user):
+        """Replace a cached document with a newer version (users that aren't cached are ignored)."""
+        if user.get("telegramId") in self.entries:
+            self.put(user)
+
+    def apply_update(self, telegram_id, update):
+        """Apply an update the bot wrote to MongoDB to the cached document.
+
+        Only plain top-level $set updates are applied in place, anything else
+        drops the cached document.
+        """
+        entry = self.entries.get(telegram_id)
+        if entry is None:
+            return
+        fields = update.get("$set")
+        if set(update) != {"$set"} or any("." in field for field in fields):
+            self.invalidate(telegram_id)
+            return
+        # Cached documents may be shared with callers, so replace rather than mutate
+        self.entries[telegram_id] = (entry[0], {**entry[1], **fields})
+
+    def invalidate(self, telegram_id):
+        self.entries.pop(telegram_id, None)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Update types that carry the user who caused them, in the order they are checked
+USER_UPDATE_FIELDS = [
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request",
+]
+
+
+def routing_key(update_data):
+    """Return the id used to route a raw update to a worker (the user's id, else the chat's)."""
+    for field in USER_UPDATE_FIELDS:
+        payload = update_data.get(field)
+        if not payload:
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return update_data.get("update_id", 0)
+
+
+async def serve_http(routes, host, port):
+    """Minimal HTTP/1.1 server for the bot's local endpoints.
+
+    routes maps (method, path) to an async function taking (headers, body) and
+    returning (status, response_body). Runs until cancelled.
+    """
+
+    async def handle_connection(reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            handler = routes.get((method, path.split("?", 1)[0]))
+            if handler is None:
+                status, response_body = 404, "Not Found"
+            else:
+                status, response_body = await handler(headers, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response_body = 400, "Bad Request"
+        except Exception as e:
+            logger.exception("Error handling HTTP request")
+            status, response_body = 500, "Internal Server Error"
+
+        response_bytes = response_body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(response_bytes)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + response_bytes
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
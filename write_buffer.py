@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindBuffer:
+    """Buffers low-priority writes and applies them in bulk_write batches.
+
+    Per collection, $set updates of the same document are merged into one
+    UpdateOne and inserts are batched. Everything buffered is written every
+    flush_interval seconds, or as soon as max_pending writes are waiting.
+    Writes that fail are kept for the next flush, and stop() keeps flushing
+    (up to max_attempts times) until nothing is left.
+    """
+
+    def __init__(self, flush_interval=1.0, max_pending=500, max_attempts=3):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.updates = {}  # collection -> {filter items: (filter, fields to $set)}
+        self.inserts = {}  # collection -> [documents]
+        self.pending = 0
+        self.wakeup = None
+        self.stopping = False
+        self.task = None
+        self.metrics = {"queued": 0, "written": 0, "failed": 0, "batches": 0}
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            # Not cancelled: a flush in progress has already taken the buffered writes
+            # out of the buffer, so the loop is left to finish it and exit
+            self.stopping = True
+            self.wakeup.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for _ in range(self.max_attempts):
+            if not self.pending:
+                return
+            await self.flush()
+        logger.error("Dropping %d buffered writes that could not be written", self.pending)
+
+    def set_fields(self, collection, document_filter, fields):
+        """Buffer {"$set": fields} on the document matching document_filter (plain field equality)."""
+        updates = self.updates.setdefault(collection, {})
+        key = tuple(sorted(document_filter.items()))
+        if key in updates:
+            updates[key][1].update(fields)
+            return
+        updates[key] = (document_filter, dict(fields))
+        self._added()
+
+    def insert(self, collection, document):
+        self.inserts.setdefault(collection, []).append(document)
+        self._added()
+
+    def _added(self):
+        self.pending += 1
+        self.metrics["queued"] += 1
+        if self.pending >= self.max_pending and self.wakeup:
+            self.wakeup.set()
+
+    async def _run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        updates, inserts = self.updates, self.inserts
+        self.updates, self.inserts, self.pending = {}, {}, 0
+        for collection in set(updates) | set(inserts):
+            buffered_updates = list(updates.get(collection, {}).values())
+            buffered_inserts = inserts.get(collection, [])
+            requests = [UpdateOne(document_filter, {"$set": fields}) for document_filter, fields in buffered_updates]
+            requests += [InsertOne(document) for document in buffered_inserts]
+            self.metrics["batches"] += 1
+            try:
+                await collection.bulk_write(requests, ordered=False)
+                failed = set()
+            except BulkWriteError as e:
+                # An insert that hit a duplicate key was already written by an earlier attempt
+                failed = {error["index"] for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY}
+                logger.warning("%d of %d buffered writes to %s failed", len(failed), len(requests), collection.name)
+            except PyMongoError as e:
+                failed = set(range(len(requests)))
+                logger.warning("Buffered writes to %s failed: %s", collection.name, e)
+            self.metrics["written"] += len(requests) - len(failed)
+            self.metrics["failed"] += len(failed)
+
+            # Keep the failed writes for the next flush (fields buffered since then take precedence)
+            for index in sorted(failed):
+                if index < len(buffered_updates):
+                    document_filter, fields = buffered_updates[index]
+                    key = tuple(sorted(document_filter.items()))
+                    retry = self.updates.setdefault(collection, {})
+                    if key in retry:
+                        retry[key] = (document_filter, {**fields, **retry[key][1]})
+                    else:
+                        retry[key] = (document_filter, fields)
+                        self.pending += 1
+                else:
+                    self.inserts.setdefault(collection, []).append(buffered_inserts[index - len(buffered_updates)])
+                    self.pending += 1